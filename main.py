@@ -1,17 +1,14 @@
 import testarch.unet as net
 import testarch.unet.runs as r
-import torchvision.transforms as tmf
 
-# Set GPU
 import torch
-torch.cuda.set_device(1)
 
-transforms = tmf.Compose([
-    tmf.ToPILImage(),
-    tmf.ToTensor()
-])
+# Patches are sent as uint8 and converted to float on the device(see NNBee._inputs_to_device)
+transforms = None
 
 runs = [r.DRIVE]
 if __name__ == "__main__":
+    # Set GPU. Here, not at import: the spawned plot renderer(see viz.plotservice) imports this module again
+    torch.cuda.set_device(1)
     net.run(runs, transforms)
 
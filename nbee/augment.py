@@ -0,0 +1,53 @@
+"""
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import torch
+
+
+class BatchAugmenter:
+    """
+    Random augmentation of a whole collated batch with a random mask per sample.
+    Inputs are (N, C, H, W) and labels (N, H, W) or (N, C, H, W) tensors. Both are flipped/rotated together around
+    their centers, so expanded inputs(eg. 572 x 572 for a 388 x 388 label) stay aligned with the labels.
+    """
+
+    def __init__(self, flip_prob=0.5, rotate=False, jitter=0.0):
+        """
+        :param flip_prob: Probability of flipping each sample along rows, and independently along columns
+        :param rotate: Also rotate each sample by a random multiple of 90 degrees(square patches only)
+        :param jitter: Scale the intensity of each input by a random gain in [1 - jitter, 1 + jitter]
+        """
+        self.flip_prob = flip_prob
+        self.rotate = rotate
+        self.jitter = jitter
+
+    @staticmethod
+    def _per_sample(mask, tensor):
+        return mask.view(-1, *([1] * (tensor.dim() - 1)))
+
+    def __call__(self, inputs, labels):
+        n, device = inputs.shape[0], inputs.device
+
+        for dim in (-2, -1):
+            flip = torch.rand(n, device=device) < self.flip_prob
+            inputs = torch.where(self._per_sample(flip, inputs), inputs.flip(dim), inputs)
+            labels = torch.where(self._per_sample(flip, labels), labels.flip(dim), labels)
+
+        if self.rotate and inputs.shape[-1] == inputs.shape[-2] and labels.shape[-1] == labels.shape[-2]:
+            k = torch.randint(0, 4, (n,), device=device)
+            rot_inputs, rot_labels = inputs, labels
+            for r in range(1, 4):
+                rot_inputs = torch.where(self._per_sample(k == r, inputs), torch.rot90(inputs, r, (-2, -1)),
+                                         rot_inputs)
+                rot_labels = torch.where(self._per_sample(k == r, labels), torch.rot90(labels, r, (-2, -1)),
+                                         rot_labels)
+            inputs, labels = rot_inputs, rot_labels
+
+        if self.jitter > 0:
+            gain = 1 + (torch.rand(n, device=device) * 2 - 1) * self.jitter
+            inputs = inputs * self._per_sample(gain, inputs)
+
+        return inputs, labels
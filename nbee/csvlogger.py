@@ -0,0 +1,100 @@
+"""
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import atexit
+import os
+import threading
+
+
+class CSVLogger:
+    """
+    Log file that takes rows without touching the disk. Rows are buffered in memory, and a background thread writes
+    them out in one go every flush_interval seconds, as soon as max_rows are pending, on flush() and on close().
+    Pending rows are also written when the process exits, normally or on an uncaught exception.
+    Has write(), flush(), close(), name and closed like the file it replaces.
+    """
+
+    def __init__(self, log_file=None, header='', flush_interval=2.0, max_rows=1000):
+        """
+        :param log_file: File to (over)write
+        :param header: First line, written right away(see NNBee.get_log_headers)
+        :param flush_interval: Seconds between background writes
+        :param max_rows: Pending rows that trigger a write before the interval
+        """
+        self.name = log_file
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self._open(header)
+        self._rows = []
+        self._lock = threading.Condition()
+        # One writer at a time, so rows reach the file in order. Training thread only waits for the swap of the buffer.
+        self._io_lock = threading.Lock()
+        self._stop = False
+        # Forked DataLoader workers inherit this object but must never write to the file
+        self._pid = os.getpid()
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _open(self, header):
+        self._file = open(self.name, 'w')
+        self._file.write(header + '\n')
+        self._file.flush()
+
+    def _write_rows(self, rows):
+        if rows:
+            self._file.write(''.join(rows))
+        self._file.flush()
+
+    def _close_file(self):
+        self._file.close()
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def write(self, msg):
+        with self._lock:
+            if self._stop:
+                raise ValueError('### Log is closed: ' + self.name)
+            self._rows.append(msg)
+            if len(self._rows) >= self.max_rows:
+                self._lock.notify()
+
+    def _drain(self):
+        with self._io_lock:
+            with self._lock:
+                rows, self._rows = self._rows, []
+            self._write_rows(rows)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._stop:
+                    self._lock.wait(self.flush_interval)
+                stop = self._stop
+            if stop:
+                return
+            self._drain()
+
+    def flush(self):
+        """
+        Write all pending rows now, eg. before the file is read for plotting.
+        """
+        if os.getpid() != self._pid or self.closed:
+            return
+        self._drain()
+
+    def close(self):
+        if os.getpid() != self._pid or self.closed:
+            return
+        with self._lock:
+            self._stop = True
+            self._lock.notify()
+        self._writer.join()
+        self._drain()
+        self._close_file()
+        atexit.unregister(self.close)
@@ -0,0 +1,209 @@
+"""
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from nbee.shmstore import SharedArray
+
+
+class ArrayCache:
+    """
+    Content addressed on-disk store of named numpy arrays.
+    Entries are keyed on the digest of the source files plus every parameter that changes the result,
+    so the same entry is reused across splits, runs and processes. Writes are atomic(write then rename),
+    hence several jobs can safely share one cache directory.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_digest(file, block_size=1 << 20):
+        """
+        :param file: Path of the file to hash. Missing file hashes as 'NONE' so the key still changes
+                    once the file appears.
+        :param block_size: Read in blocks of this many bytes
+        :return: sha1 hex digest of file content
+        """
+        if file is None or not os.path.isfile(file):
+            return 'NONE'
+        sha = hashlib.sha1()
+        with open(file, 'rb') as f:
+            for block in iter(lambda: f.read(block_size), b''):
+                sha.update(block)
+        return sha.hexdigest()
+
+    @staticmethod
+    def key(*parts):
+        """
+        :param parts: Anything with a stable repr(file digests, preprocessing parameters...)
+        :return: Key of the cache entry
+        """
+        return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def get(self, key):
+        """
+        :param key: Key from ArrayCache.key()
+        :return: dict of arrays, None if there is no such entry
+        """
+        path = self._path(key)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with np.load(path) as entry:
+                return {k: entry[k] for k in entry.files}
+        except Exception as e:
+            print('### Corrupt cache entry ignored: ' + path + ': ' + str(e))
+            return None
+
+    def put(self, key, arrays=None):
+        """
+        :param key: Key from ArrayCache.key()
+        :param arrays: dict of name->array. None values are skipped and come back missing from get().
+        """
+        arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items() if v is not None}
+        # Unique name per writer(process or thread), so a racing put of the same key never publishes a partial file
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, prefix=key + '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **arrays)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+
+class PatchStore:
+    """
+    Fixed shape uint8 patches(inputs and labels) of a whole dataset materialized once into two contiguous files,
+    <key>.inputs.u8 and <key>.labels.u8, with a json sidecar <key>.json holding the shapes and the patch index.
+    Reading a patch is then just a slice of a memory map.
+    """
+
+    def __init__(self, store_dir=None, key=None):
+        self.store_dir = store_dir
+        self.key = key
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.inputs_file = os.path.join(self.store_dir, key + '.inputs.u8')
+        self.labels_file = os.path.join(self.store_dir, key + '.labels.u8')
+        self.index_file = os.path.join(self.store_dir, key + '.json')
+
+    def exists(self):
+        # Sidecar is written last, so its presence means the store is complete
+        return os.path.isfile(self.index_file)
+
+    def write(self, index=None, input_shape=None, label_shape=None, get_patch=None):
+        """
+        :param index: List of patch indices(any json serializable rows) in the order patches will be stored
+        :param input_shape: Shape of each input patch
+        :param label_shape: Shape of each label patch
+        :param get_patch: Function that takes a row of index and returns (input_patch, label_patch)
+        """
+        # Unique tmp names per writer(process or thread), so racing writers of one key never mix their files
+        tmp = {}
+        for file in [self.inputs_file, self.labels_file, self.index_file]:
+            fd, tmp[file] = tempfile.mkstemp(dir=self.store_dir, prefix=os.path.basename(file) + '.', suffix='.tmp')
+            os.close(fd)
+        try:
+            inputs = np.memmap(tmp[self.inputs_file], dtype=np.uint8, mode='w+',
+                               shape=(len(index),) + tuple(input_shape))
+            labels = np.memmap(tmp[self.labels_file], dtype=np.uint8, mode='w+',
+                               shape=(len(index),) + tuple(label_shape))
+            for i, ix in enumerate(index):
+                inputs[i], labels[i] = get_patch(ix)
+            inputs.flush()
+            labels.flush()
+            del inputs, labels
+            os.replace(tmp[self.inputs_file], self.inputs_file)
+            os.replace(tmp[self.labels_file], self.labels_file)
+
+            with open(tmp[self.index_file], 'w') as f:
+                json.dump({'input_shape': list(input_shape), 'label_shape': list(label_shape), 'index': index}, f)
+            os.replace(tmp[self.index_file], self.index_file)
+        finally:
+            for file in tmp.values():
+                if os.path.exists(file):
+                    os.remove(file)
+
+    def open(self):
+        """
+        :return: inputs, labels as read only memory maps of shape (N, *patch_shape), and the stored index.
+                The maps pickle as references, so DataLoader workers attach to the same files.
+        """
+        with open(self.index_file) as f:
+            meta = json.load(f)
+        n = len(meta['index'])
+        inputs = SharedArray(self.inputs_file, dtype=np.uint8, mode='r', shape=(n,) + tuple(meta['input_shape']))
+        labels = SharedArray(self.labels_file, dtype=np.uint8, mode='r', shape=(n,) + tuple(meta['label_shape']))
+        return inputs, labels, meta['index']
+
+
+class LRUImageCache:
+    """
+    Dict like ID -> image object that holds at most max_bytes worth of image arrays.
+    Least recently used images are dropped once over budget(the most recent one is always kept), and an image that
+    is not held is loaded again with load(ID) on access.
+    """
+
+    def __init__(self, load=None, max_bytes=None):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._objects = OrderedDict()
+        self._sizes = {}
+        self._ids = []
+
+    @staticmethod
+    def image_nbytes(img_obj):
+        arrays = [img_obj.image_arr, img_obj.working_arr, img_obj.mask, img_obj.ground_truth]
+        arrays += list(img_obj.extra.values())
+        return sum(arr.nbytes for arr in arrays if isinstance(arr, np.ndarray))
+
+    def __setitem__(self, ID, img_obj):
+        if ID in self._objects:
+            self.nbytes -= self._sizes.pop(ID)
+            del self._objects[ID]
+        elif ID not in self._ids:
+            self._ids.append(ID)
+
+        self._objects[ID] = img_obj
+        self._sizes[ID] = self.image_nbytes(img_obj)
+        self.nbytes += self._sizes[ID]
+        while self.nbytes > self.max_bytes and len(self._objects) > 1:
+            old, _ = self._objects.popitem(last=False)
+            self.nbytes -= self._sizes.pop(old)
+
+    def __getitem__(self, ID):
+        if ID in self._objects:
+            self._objects.move_to_end(ID)
+            return self._objects[ID]
+        img_obj = self.load(ID)
+        self[ID] = img_obj
+        return img_obj
+
+    def __contains__(self, ID):
+        return ID in self._ids
+
+    def __len__(self):
+        return len(self._ids)
+
+    def keys(self):
+        return list(self._ids)
+
+    def items(self):
+        for ID in self._ids:
+            yield ID, self[ID]
@@ -4,17 +4,51 @@
 ### date: 9/10/2018
 """
 
+import multiprocessing as mp
 import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from random import shuffle
 
+import numpy as np
 import torch
 import torchvision.transforms as tfm
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import Sampler, WeightedRandomSampler
 
+import nbee.distributed as ddp
 from utils.img_utils import Image
+from utils.datapack import DataPack
 import utils.data_utils as dutils
+from nbee.datacache import ArrayCache, LRUImageCache
+from nbee.shmstore import SharedArrayStore
+
+# Generator being loaded by a process pool. Forked workers inherit it, so it never has to be pickled.
+_POOL_GEN = None
+
+
+def _pool_get_image_obj(img_file):
+    return _POOL_GEN._get_image_obj(img_file)
+
+
+class _FileNames:
+    """
+    Picklable stand-in for a mask/truth getter(those of runs.py are lambdas), with the names of a known list of images
+    """
+
+    def __init__(self, getter=None, images=None):
+        self.names = {f: getter(f) for f in images}
+
+    def __call__(self, file_name):
+        return self.names[file_name]
 
 
 class Generator(Dataset):
+    # Default pool to load images with, 'thread' or 'process'. Params['load_pool'] overrides it.
+    load_pool = 'thread'
+    # Batch size of evaluation loaders, None to use Params['batch_size']
+    eval_batch_size = None
+
     def __init__(self, conf=None, images=None,
                  transforms=None, shuffle_indices=False, mode=None, **kwargs):
 
@@ -27,51 +61,247 @@ class Generator(Dataset):
         self.shuffle_indices = shuffle_indices
         self.transforms = transforms
         self.mode = mode
+        self.load_pool = self.conf.get('Params').get('load_pool', self.load_pool)
+        self.load_workers = self.conf.get('Params').get('load_workers', os.cpu_count() or 1)
+        self.clahe_clip_limit = self.conf.get('Params').get('clahe_clip_limit', 2.0)
+        self.clahe_tile_shape = tuple(self.conf.get('Params').get('clahe_tile_shape', (8, 8)))
+
+        # Preprocessed images are cached on disk if a cache directory is given
+        self.cache = None
+        if self.conf.get('Dirs').get('cache') is not None:
+            self.cache = ArrayCache(self.conf.get('Dirs').get('cache'))
+
+        # Images, masks and ground truths are read from one DataPack file(see utils.datapack) if given
+        self.pack = None
+        if self.conf.get('Dirs').get('pack') is not None:
+            self.pack = DataPack(self.conf.get('Dirs').get('pack'))
 
         if images is not None:
             self.images = images
+        elif self.pack is not None:
+            self.images = list(self.pack.images)
         else:
             self.images = os.listdir(self.image_dir)
         self.image_objects = {}
-        self.indices = []
+        # Patch index table, one row of [ID, row_from, row_to, col_from, col_to(, ...)] per sample
+        self.indices = np.zeros((0, 5), dtype=np.int32)
+        # Training draw weight of each row of indices(see get_loader), None to draw all alike
+        self.patch_weights = None
+        self.store = None
+        self.cls_stats = dutils.ClassWeightStats()
+
+        # Lazy mode: images live in a LRU cache bounded by Params['image_cache_bytes'] and are loaded again on access
+        self.lazy = self.conf.get('Params').get('image_cache_bytes') is not None
+        if self.lazy:
+            self.image_objects = LRUImageCache(load=self._get_image_obj_by_id,
+                                               max_bytes=self.conf.get('Params').get('image_cache_bytes'))
 
     def _load_indices(self):
         pass
 
-    def _get_image_obj(self, img_file=None):
+    @staticmethod
+    def _index_table(ID, chunk_indices):
+        """
+        :param ID: ID of the image
+        :param chunk_indices: (N, 4) patch corners, see utils.img_utils.get_chunk_indexes_array
+        :return: (N, 5) int32 rows of the index table
+        """
+        table = np.empty((len(chunk_indices), 5), dtype=np.int32)
+        table[:, 0] = ID
+        table[:, 1:] = chunk_indices
+        return table
+
+    def _shuffle_indices(self):
+        order = np.random.permutation(len(self.indices))
+        self.indices = self.indices[order]
+        if self.patch_weights is not None:
+            self.patch_weights = self.patch_weights[order]
+
+    def _load_image_objects(self):
+        """
+        Load(self._get_image_obj) all images across a pool of Params['load_workers'] threads or processes.
+        At most as many images as there are workers are loaded ahead of the consumer.
+        Process pools need fork, otherwise threads are used.
+        :return: Generator of (ID, image object) in the order of self.images
+        """
+        workers = min(self.load_workers, len(self.images))
+        if workers <= 1:
+            for ID, img_file in enumerate(self.images):
+                yield ID, self._get_image_obj(img_file)
+            return
+
+        if self.load_pool == 'process' and 'fork' in mp.get_all_start_methods():
+            global _POOL_GEN
+            _POOL_GEN = self
+            pool, load = ProcessPoolExecutor(workers, mp_context=mp.get_context('fork')), _pool_get_image_obj
+        else:
+            pool, load = ThreadPoolExecutor(workers), self._get_image_obj
+
+        with pool:
+            futures = [pool.submit(load, img_file) for img_file in self.images[:workers]]
+            for ID in range(len(self.images)):
+                if ID + workers < len(self.images):
+                    futures.append(pool.submit(load, self.images[ID + workers]))
+                yield ID, futures[ID].result()
+                futures[ID] = None
+
+    def _load_image_obj(self, img_file=None):
+        """
+        :param img_file: Image file name
+        :return: Image object with image_arr, mask and ground_truth, from the DataPack if there is one else from files
+        """
+        if self.pack is not None:
+            return self.pack.get_image_obj(img_file)
+
         img_obj = Image()
         img_obj.load_file(data_dir=self.image_dir, file_name=img_file)
         if self.mask_getter is not None:
             img_obj.load_mask(mask_dir=self.mask_dir, fget_mask=self.mask_getter)
         if self.truth_getter is not None:
             img_obj.load_ground_truth(gt_dir=self.truth_dir, fget_ground_truth=self.truth_getter)
+        return img_obj
 
-        img_obj.working_arr = img_obj.image_arr
-        img_obj.apply_clahe()
+    def _get_cache_key(self, img_file=None, channel=None):
+        if self.pack is not None:
+            # Pack keeps the digest of each original file, so keys are the same as when reading the files
+            digests = [(self.pack.get_entry(img_file, k) or {}).get('digest', 'NONE')
+                       for k in ['image', 'mask', 'truth']]
+            return ArrayCache.key('Generator', *digests, channel, self.clahe_clip_limit, self.clahe_tile_shape)
+
+        mask_file, truth_file = None, None
+        if self.mask_getter is not None:
+            mask_file = os.path.join(self.mask_dir, self.mask_getter(img_file))
+        if self.truth_getter is not None:
+            truth_file = os.path.join(self.truth_dir, self.truth_getter(img_file))
+        return ArrayCache.key('Generator', ArrayCache.file_digest(os.path.join(self.image_dir, img_file)),
+                              ArrayCache.file_digest(mask_file), ArrayCache.file_digest(truth_file),
+                              channel, self.clahe_clip_limit, self.clahe_tile_shape)
+
+    def _get_image_obj(self, img_file=None, channel=None, key=None):
+        """
+        Load an image with its mask and ground truth, apply clahe and mask.
+        If a cache is configured, the finished working_arr, mask, ground_truth and the label histogram of
+        ground_truth(extra['truth_hist'], see gen_class_weights) are read from/written to it.
+        A cached image object does not carry image_arr.
+        :param img_file: Image file name
+        :param channel: Only use this channel of the image(None for all)
+        :param key: Cache key of the image, if the caller already has it from _get_cache_key(img_file, channel)
+        :return: Image object
+        """
+        if self.cache is None:
+            key = None
+        elif key is None:
+            key = self._get_cache_key(img_file, channel)
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                img_obj = Image()
+                img_obj.data_dir = self.image_dir
+                img_obj.file_name = img_file
+                img_obj.working_arr = cached['working_arr']
+                img_obj.mask = cached.get('mask')
+                img_obj.ground_truth = cached.get('ground_truth')
+                if cached.get('truth_hist') is not None:
+                    img_obj.extra['truth_hist'] = cached['truth_hist']
+                return img_obj
+
+        img_obj = self._load_image_obj(img_file)
+        img_obj.working_arr = img_obj.image_arr if channel is None else img_obj.image_arr[:, :, channel]
+        img_obj.apply_clahe(clip_limit=self.clahe_clip_limit, tile_shape=self.clahe_tile_shape)
         img_obj.apply_mask()
+
+        if key is not None:
+            if img_obj.ground_truth is not None:
+                img_obj.extra['truth_hist'] = dutils.get_label_histogram(img_obj.ground_truth)
+            self.cache.put(key, {'working_arr': img_obj.working_arr, 'mask': img_obj.mask,
+                                 'ground_truth': img_obj.ground_truth, 'truth_hist': img_obj.extra.get('truth_hist')})
         return img_obj
 
+    def _get_image_obj_by_id(self, ID):
+        return self._get_image_obj(self.images[ID])
+
+    def share_memory(self):
+        """
+        Back all image objects by a shared memory store so that DataLoader workers attach to the same arrays
+        instead of each holding its own copy. Arrays become read only.
+        """
+        if self.lazy:
+            print('### Lazy loaded images are not shared.')
+            return
+        if self.store is None:
+            self.store = SharedArrayStore()
+        for _, obj in self.image_objects.items():
+            self.store.share_image(obj)
+
+    def close(self):
+        """
+        Remove the shared memory store of the images(see share_memory), eg. once the split that used them is done.
+        """
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __getstate__(self):
+        # Workers started with spawn/forkserver receive a pickled copy. They never need the functions in conf
+        # (lambdas can't be pickled anyway), and shared arrays pickle as references to the store.
+        # Getters are resolved for all images beforehand, so images(re)loaded in a worker still get their mask and
+        # ground truth, and the same cache keys.
+        state = self.__dict__.copy()
+        state['conf'] = {k: v for k, v in self.conf.items() if k != 'Funcs'}
+        for k in ['mask_getter', 'truth_getter']:
+            if state[k] is not None:
+                state[k] = _FileNames(state[k], self.images)
+        return state
+
     def __getitem__(self, index):
         pass
 
     def __len__(self):
         return len(self.indices)
 
-    def gen_class_weights(self):
+    def gen_class_weights(self, ids=None):
+        """
+        Set Params['cls_weights'] from the ground truth of training images.
+        :param ids: IDs of images to use. Default is all images, and only if this is a training generator.
+        """
+        if ids is None:
+            if self.mode != 'train':
+                return
+            ids = list(range(len(self.images)))
+
+        # Only images that entered or left the set since the last call are visited
+        ids = set(ids)
+        for ID in self.cls_stats.keys():
+            if ID not in ids:
+                self.cls_stats.remove(ID)
+        for ID in sorted(ids):
+            if ID not in self.cls_stats:
+                self.cls_stats.add(ID, self._get_truth_hist(ID))
+        self.conf['Params']['cls_weights'] = self.cls_stats.get_class_weights()
 
-        if self.mode != 'train':
-            return
+    def _get_truth_hist(self, ID):
+        img_obj = self.image_objects[ID]
+        if img_obj.extra.get('truth_hist') is None:
+            img_obj.extra['truth_hist'] = dutils.get_label_histogram(img_obj.ground_truth)
+        return img_obj.extra['truth_hist']
 
-        self.conf['Params']['cls_weights'] = [0, 0]
-        for _, obj in self.image_objects.items():
-            self.conf['Params']['cls_weights'][0] += dutils.get_class_weights(obj.ground_truth)[0]
-            self.conf['Params']['cls_weights'][1] += dutils.get_class_weights(obj.ground_truth)[255]
+    @staticmethod
+    def pin_memory(conf):
+        # Batches go to the gpu with non_blocking copies(see NNBee._inputs_to_device) if they are in pinned memory
+        return bool(conf['Params'].get('use_gpu', False)) and torch.cuda.is_available()
 
-        self.conf['Params']['cls_weights'][0] = self.conf['Params']['cls_weights'][0] / len(self.image_objects)
-        self.conf['Params']['cls_weights'][1] = self.conf['Params']['cls_weights'][1] / len(self.image_objects)
+    @staticmethod
+    def loader_workers(conf, train=True):
+        """
+        :return: DataLoader arguments num_workers and persistent_workers of a training(default 5 workers) or
+                validation/test(default 3 workers) loader. Workers outlive an epoch only if asked for.
+        """
+        num_workers = conf['Params'].get('num_workers' if train else 'eval_workers', 5 if train else 3)
+        return {'num_workers': num_workers,
+                'persistent_workers': bool(conf['Params'].get('persistent_workers', False)) and num_workers > 0}
 
     @classmethod
-    def get_loader(cls, images, conf, transforms, mode, batch_sizes=[]):
+    def get_loader(cls, images, conf, transforms, mode, batch_sizes=[], pool=None):
         """
         ###### GET list dataloaders of different batch sizes as specified in batch_sizes
         :param images: List of images for which the torch dataloader will be generated
@@ -80,28 +310,221 @@ class Generator(Dataset):
         :param mode: 'train' or 'test'
         :param batch_sizes: Default will pick from runs.py. List of integers(batch_size)
                 will generate a loader for each batch size
+        :param pool: LoaderPool(see get_loader_pool) to take the loader from instead of starting new workers
         :return: loader if batch_size is default else list of loaders
         """
+        if pool is not None:
+            return pool.get_loader(images=images, mode=mode)
+
         batch_sizes = [conf['Params']['batch_size']] if len(batch_sizes) == 0 else batch_sizes
         gen = cls(conf=conf, images=images, transforms=transforms, shuffle_indices=True, mode=mode)
+        if conf['Params'].get('shared_memory'):
+            gen.share_memory()
+
+        # Keep patches of an image together when images are lazily loaded, so that the LRU cache of each worker hits
+        sampler = None
+        if gen.lazy:
+            sampler = ImageGroupedSampler(gen)
+            if gen.patch_weights is not None:
+                print('### Patch weights are not used with lazy loaded images.')
+        elif gen.patch_weights is not None:
+            sampler = WeightedRandomSampler(gen.patch_weights.tolist(), num_samples=len(gen), replacement=True)
+
+        # Each rank of a distributed run trains on its own share of the patches(NNBee.train sets the epoch)
+        if ddp.is_distributed():
+            if sampler is not None:
+                print('### Distributed run, patches are not grouped/weighted.')
+            sampler = DistributedSampler(gen, shuffle=True)
 
         dls = []
         for bz in batch_sizes:
-            dls.append(torch.utils.data.DataLoader(gen, batch_size=bz, shuffle=True, num_workers=5, sampler=None))
+            dls.append(torch.utils.data.DataLoader(gen, batch_size=bz, shuffle=sampler is None, sampler=sampler,
+                                                   pin_memory=cls.pin_memory(conf), **cls.loader_workers(conf)))
         return dls if len(dls) > 1 else dls[0]
 
     @classmethod
-    def get_loader_per_img(cls, images, conf, mode, transforms):
-        loaders = []
-        for file in images:
-            gen = cls(
-                conf=conf,
-                images=[file],
-                transforms=transforms,
-                shuffle_indices=False,
-                mode=mode
-            )
-            loader = torch.utils.data.DataLoader(gen, batch_size=min(conf['Params']['batch_size'], gen.__len__()),
-                                                 shuffle=False, num_workers=3, sampler=None)
-            loaders.append(loader)
-        return loaders
+    def get_eval_loader(cls, images, conf, mode, transforms, pool=None):
+        """
+        ###### GET one loader over all images for validation/test.
+        Patches come image after image(shuffle off), each sample tagged with its image 'id' and 'clip_ix',
+        so that NNBee._eval_per_image can reassemble per image results from it.
+        In a distributed run, each rank gets its share of validation images.
+        :param images: List of images
+        :param conf: JSON file. see runs.py
+        :param mode: 'validation' or 'test'
+        :param transforms: torchvision composed transforms
+        :param pool: LoaderPool(see get_loader_pool) to take the loader from instead of starting new workers
+        :return: loader
+        """
+        if pool is not None:
+            return pool.get_loader(images=images, mode=mode)
+
+        # Ranks of a distributed run validate different images, scores are summed up after
+        if mode == 'validation' and ddp.is_distributed():
+            images = images[ddp.get_rank()::ddp.get_world_size()]
+
+        gen = cls(conf=conf, images=images, transforms=transforms, shuffle_indices=False, mode=mode)
+        if conf['Params'].get('shared_memory'):
+            gen.share_memory()
+        batch_size = cls.eval_batch_size if cls.eval_batch_size else conf['Params']['batch_size']
+        return torch.utils.data.DataLoader(gen, batch_size=min(batch_size, max(gen.__len__(), 1)),
+                                           shuffle=False, sampler=None, pin_memory=cls.pin_memory(conf),
+                                           **cls.loader_workers(conf, train=False))
+
+    @classmethod
+    def get_loader_pool(cls, images, conf, transforms):
+        """
+        ###### GET a LoaderPool over all images of a run(eg. union of all splits).
+        Loaders of every phase and split taken from it share the same persistent workers.
+        :param images: All images that any loader will be asked for
+        :param conf: JSON file. see runs.py
+        :param transforms: torchvision composed transforms
+        :return: LoaderPool
+        """
+        gen = cls(conf=conf, images=images, transforms=transforms, shuffle_indices=False, mode=None)
+        if conf['Params'].get('shared_memory'):
+            gen.share_memory()
+        return LoaderPool(generator=gen, conf=conf)
+
+
+def close_loaders(*loaders):
+    """
+    Close(see Generator.close) the generators of loaders built by get_loader/get_eval_loader. Loaders of a
+    LoaderPool, and None, are skipped: the pool lives for the whole run.
+    """
+    for loader in loaders:
+        if isinstance(getattr(loader, 'dataset', None), Generator):
+            loader.dataset.close()
+
+
+def _group_by_image(indices, ids=None):
+    """
+    :param indices: Index table of a generator
+    :param ids: Only these image IDs. Default all.
+    :return: dict of ID -> positions of its rows in the table, in table order
+    """
+    order = np.argsort(indices[:, 0], kind='stable')
+    keys, starts = np.unique(indices[order, 0], return_index=True)
+    groups = dict(zip(keys.tolist(), np.split(order, starts[1:])))
+    if ids is not None:
+        groups = {ID: positions for ID, positions in groups.items() if ID in ids}
+    return groups
+
+
+class ImageGroupedSampler(Sampler):
+    """
+    Visits images in random order and all patches of an image one after another(in random order).
+    """
+
+    def __init__(self, generator=None):
+        self.generator = generator
+
+    def __iter__(self):
+        groups = _group_by_image(self.generator.indices)
+        order = list(groups.keys())
+        shuffle(order)
+        for ID in order:
+            for i in np.random.permutation(groups[ID]).tolist():
+                yield i
+
+    def __len__(self):
+        return len(self.generator)
+
+
+class PhaseBatchSampler(Sampler):
+    """
+    Batch sampler over the patches of a subset of images. The subset, order and batch size can be switched
+    between iterations, which lets a DataLoader with persistent workers serve training, validation and test.
+    """
+
+    def __init__(self, generator=None):
+        self.generator = generator
+        self.ids, self.batch_size, self.shuffle = set(), 1, False
+
+    def set_phase(self, ids=None, batch_size=1, shuffle=False):
+        self.ids, self.batch_size, self.shuffle = set(ids), batch_size, shuffle
+
+    def _positions(self):
+        groups = _group_by_image(self.generator.indices, self.ids)
+        order = sorted(groups.keys())
+        if self.shuffle and self.generator.lazy:
+            # Keep patches of an image together, see ImageGroupedSampler
+            shuffle(order)
+            for ID in order:
+                groups[ID] = np.random.permutation(groups[ID])
+        positions = np.concatenate([groups[ID] for ID in order]) if order else np.zeros(0, dtype=np.int64)
+        if self.shuffle and not self.generator.lazy:
+            positions = np.random.permutation(positions)
+        return positions.tolist()
+
+    def __iter__(self):
+        positions = self._positions()
+        for i in range(0, len(positions), self.batch_size):
+            yield positions[i:i + self.batch_size]
+
+    def __len__(self):
+        n = int(np.isin(self.generator.indices[:, 0], list(self.ids)).sum())
+        return (n + self.batch_size - 1) // self.batch_size
+
+
+class LoaderPool:
+    """
+    One DataLoader with persistent workers over all images of a run. PhaseLoaders taken from it(training, validation,
+    test of any split) only switch what its batch sampler yields, so worker processes are started once per run.
+    """
+
+    def __init__(self, generator=None, conf=None, num_workers=None):
+        """
+        :param num_workers: Worker processes, default Params['num_workers'](5)
+        """
+        if num_workers is None:
+            num_workers = Generator.loader_workers(conf)['num_workers']
+        self.generator = generator
+        self.conf = conf
+        self.batch_sampler = PhaseBatchSampler(generator)
+        self.loader = torch.utils.data.DataLoader(generator, batch_sampler=self.batch_sampler,
+                                                  num_workers=num_workers, persistent_workers=num_workers > 0,
+                                                  pin_memory=Generator.pin_memory(conf))
+
+    def get_loader(self, images=None, mode=None):
+        """
+        :param images: Images(must be in the pool) to load patches from
+        :param mode: 'train' shuffles, sets class weights and uses Params['batch_size'],
+                    else patches come image after image with eval batch size as in Generator.get_eval_loader
+        :return: PhaseLoader
+        """
+        ids = [self.generator.images.index(file) for file in images]
+        if mode == 'train':
+            self.generator.gen_class_weights(ids=ids)
+            return PhaseLoader(self, images, ids, self.conf['Params']['batch_size'], True)
+        batch_size = self.generator.eval_batch_size if self.generator.eval_batch_size else \
+            self.conf['Params']['batch_size']
+        return PhaseLoader(self, images, ids, batch_size, False)
+
+
+class PhaseLoader:
+    """
+    Loader of one phase of a LoaderPool. Iterates like a DataLoader. Its dataset only exposes images and
+    image_objects(indexed by pool ID as in the 'id' of each sample).
+    """
+
+    def __init__(self, pool=None, images=None, ids=None, batch_size=1, shuffle=False):
+        self.pool = pool
+        self.ids = ids
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.dataset = _PhaseDataset(images=images, image_objects=pool.generator.image_objects)
+
+    def __iter__(self):
+        self.pool.batch_sampler.set_phase(ids=self.ids, batch_size=self.batch_size, shuffle=self.shuffle)
+        return iter(self.pool.loader)
+
+    def __len__(self):
+        self.pool.batch_sampler.set_phase(ids=self.ids, batch_size=self.batch_size, shuffle=self.shuffle)
+        return len(self.pool.batch_sampler)
+
+
+class _PhaseDataset:
+    def __init__(self, images=None, image_objects=None):
+        self.images = images
+        self.image_objects = image_objects
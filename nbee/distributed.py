@@ -0,0 +1,88 @@
+"""
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as tmp
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_master():
+    # Only rank 0 writes checkpoints, logs and images
+    return get_rank() == 0
+
+
+def all_reduce_sum(values=None):
+    """
+    :param values: List of numbers
+    :return: Sum of each over all ranks(same list when not distributed)
+    """
+    if not is_distributed():
+        return values
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return t.tolist()
+
+
+def all_gather_list(values=None):
+    """
+    :param values: List of picklable items
+    :return: Lists of all ranks joined, rank 0 first(same list when not distributed)
+    """
+    if not is_distributed():
+        return values
+    gathered = [None] * get_world_size()
+    dist.all_gather_object(gathered, values)
+    return [v for rank_values in gathered for v in rank_values]
+
+
+def _worker(local_rank, fn, args, nprocs, node_rank, nnodes):
+    rank, world_size = node_rank * nprocs + local_rank, nnodes * nprocs
+    # Ranks of a host share its cores
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // nprocs))
+    dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+    try:
+        fn(*args)
+    finally:
+        dist.destroy_process_group()
+
+
+def launch(fn=None, *args, nprocs=1):
+    """
+    Run fn(*args) as nprocs ranks(forked, so conf with lambdas needs no pickling) joined into a gloo process group.
+    For several hosts, run the same on each with MASTER_ADDR, MASTER_PORT(of the host of rank 0), NNODES and
+    NODE_RANK set. A process already started as one rank(RANK, WORLD_SIZE set, eg. by torchrun) just joins the group.
+    :param fn: Function to run in each rank
+    :param args: Arguments of fn
+    :param nprocs: Number of ranks on this host
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        dist.init_process_group(backend='gloo', rank=int(os.environ['RANK']),
+                                world_size=int(os.environ['WORLD_SIZE']))
+        try:
+            fn(*args)
+        finally:
+            dist.destroy_process_group()
+        return
+
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    nnodes, node_rank = int(os.environ.get('NNODES', 1)), int(os.environ.get('NODE_RANK', 0))
+    tmp.start_processes(_worker, args=(fn, args, nprocs, node_rank, nnodes), nprocs=nprocs, join=True,
+                        start_method='fork')
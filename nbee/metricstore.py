@@ -0,0 +1,254 @@
+"""
+Append only columnar store of per batch metrics, with rollups(mean per N rows and per epoch) kept as they are written
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+from nbee.csvlogger import CSVLogger
+
+"""
+#####################################################################################
+Store layout(a directory):
+    meta.json                   columns, dtype of each column, rollups
+    raw/<COLUMN>.bin            one fixed width binary file per column, a value per logged row
+    r<N>/<COLUMN>.bin           mean of numeric columns over each N rows, with ROW(first row) and COUNT
+    epoch/<COLUMN>.bin          same, over the rows of each epoch
+Files are only ever appended. A reader takes as many rows as the shortest of the columns it reads has.
+#####################################################################################
+"""
+
+_TEXT = 'S64'
+
+
+class MetricStore:
+    """
+    Writes rows(lists of the values of all columns, as text or numbers) into a store directory.
+    Numeric columns are float64, the others fixed width bytes.
+    """
+
+    def __init__(self, store_dir=None, columns=None, rollups=(100, 1000), epoch_column='EPOCH'):
+        """
+        :param store_dir: Directory to (over)write
+        :param columns: Column names, eg. header of NNBee.get_log_headers split on ','
+        :param rollups: Sizes N of the per N rows rollups
+        :param epoch_column: Column that rows are rolled up by per epoch, if it is one of columns
+        """
+        self.store_dir = store_dir
+        self.columns = columns
+        self.rollups = list(rollups)
+        self.epoch_column = epoch_column if epoch_column in columns else None
+        self.dtypes = None
+        self.rows = 0
+        # Running sums of the numeric columns of each rollup level: level -> [sums, count, first row, epoch]
+        self._levels = {}
+        if os.path.exists(self.store_dir):
+            shutil.rmtree(self.store_dir)
+        os.makedirs(os.path.join(self.store_dir, 'raw'))
+
+    def _init_dtypes(self, rows):
+        self.dtypes = {}
+        for i, col in enumerate(self.columns):
+            try:
+                [float(r[i]) for r in rows]
+                self.dtypes[col] = '<f8'
+            except ValueError:
+                self.dtypes[col] = _TEXT
+        self._numeric = [i for i, col in enumerate(self.columns) if self.dtypes[col] == '<f8']
+
+        levels = ['r' + str(n) for n in self.rollups] + (['epoch'] if self.epoch_column else [])
+        for level in levels:
+            os.makedirs(os.path.join(self.store_dir, level))
+            self._levels[level] = [np.zeros(len(self._numeric)), 0, 0, None]
+        with open(os.path.join(self.store_dir, 'meta.json'), 'w') as f:
+            json.dump({'columns': self.columns, 'dtypes': self.dtypes, 'rollups': self.rollups,
+                       'epoch_column': self.epoch_column}, f)
+
+    @staticmethod
+    def _to_float(v):
+        try:
+            return float(v)
+        except ValueError:
+            return np.nan
+
+    def _append(self, level, arrays):
+        for col, arr in arrays.items():
+            with open(os.path.join(self.store_dir, level, col + '.bin'), 'ab') as f:
+                f.write(arr.tobytes())
+
+    def _roll(self, level, out):
+        sums, count, first, _ = self._levels[level]
+        if count == 0:
+            return
+        out[level].append([first, count] + (sums / count).tolist())
+        self._levels[level] = [np.zeros(len(self._numeric)), 0, 0, None]
+
+    def append(self, rows=None):
+        """
+        :param rows: List of rows, each a list of the values of all columns
+        """
+        if not rows:
+            return
+        if self.dtypes is None:
+            self._init_dtypes(rows)
+
+        cols = list(zip(*rows))
+        raw = {}
+        for i, col in enumerate(self.columns):
+            if self.dtypes[col] == _TEXT:
+                raw[col] = np.array([str(v).encode('utf-8')[:64] for v in cols[i]], dtype=_TEXT)
+            else:
+                raw[col] = np.array([self._to_float(v) for v in cols[i]], dtype='<f8')
+        self._append('raw', raw)
+
+        numeric = np.stack([raw[self.columns[i]] for i in self._numeric], 1)
+        epochs = raw[self.epoch_column] if self.epoch_column else None
+        out = {level: [] for level in self._levels}
+        for j in range(len(rows)):
+            for level, state in self._levels.items():
+                if level == 'epoch' and state[1] > 0 and epochs[j] != state[3]:
+                    self._roll(level, out)
+                    state = self._levels[level]
+                if state[1] == 0:
+                    state[2], state[3] = self.rows + j, epochs[j] if epochs is not None else None
+                state[0] += numeric[j]
+                state[1] += 1
+                if level != 'epoch' and state[1] == int(level[1:]):
+                    self._roll(level, out)
+        self.rows += len(rows)
+        self._write_rollups(out)
+
+    def _write_rollups(self, out):
+        for level, rolled in out.items():
+            if not rolled:
+                continue
+            rolled = np.array(rolled)
+            arrays = {'ROW': rolled[:, 0].astype('<i8'), 'COUNT': rolled[:, 1].astype('<i8')}
+            for k, i in enumerate(self._numeric):
+                arrays[self.columns[i]] = rolled[:, 2 + k].astype('<f8')
+            self._append(level, arrays)
+
+    def close(self):
+        """
+        Write the last(incomplete) group of each rollup.
+        """
+        out = {level: [] for level in self._levels}
+        for level in list(self._levels):
+            self._roll(level, out)
+        self._write_rollups(out)
+
+
+class MetricsLogger(CSVLogger):
+    """
+    CSVLogger that writes its rows into a MetricStore(directory log_file) instead of a csv.
+    """
+
+    def __init__(self, log_file=None, header='', rollups=(100, 1000), **kw):
+        self.rollups = rollups
+        CSVLogger.__init__(self, log_file=log_file, header=header, **kw)
+
+    def _open(self, header):
+        self._store = MetricStore(store_dir=self.name, columns=header.split(','), rollups=self.rollups)
+        self._closed = False
+
+    def _write_rows(self, rows):
+        self._store.append([r.rstrip('\n').split(',') for r in rows])
+
+    def _close_file(self):
+        self._store.close()
+        self._closed = True
+
+    @property
+    def closed(self):
+        return self._closed
+
+
+def is_store(path=None):
+    return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+def get_meta(store_dir=None):
+    with open(os.path.join(store_dir, 'meta.json')) as f:
+        return json.load(f)
+
+
+def get_levels(store_dir=None):
+    """
+    :return: Resolutions of the store, finest first: 'raw', 'r<N>'..., 'epoch'
+    """
+    meta = get_meta(store_dir)
+    return ['raw'] + ['r' + str(n) for n in sorted(meta['rollups'])] + (['epoch'] if meta['epoch_column'] else [])
+
+
+def _num_rows(store_dir, level, columns, dtypes):
+    sizes = [os.path.getsize(os.path.join(store_dir, level, c + '.bin')) // np.dtype(dtypes[c]).itemsize
+             if os.path.isfile(os.path.join(store_dir, level, c + '.bin')) else 0 for c in columns]
+    return min(sizes) if sizes else 0
+
+
+def read_metrics(store_dir=None, columns=None, level=None, max_rows=None):
+    """
+    Read only the columns and the resolution needed.
+    :param store_dir: Store directory
+    :param columns: Columns to read, default all(of that level)
+    :param level: 'raw', 'r<N>' or 'epoch'(see get_levels)
+    :param max_rows: With no level, the finest of raw and per N rows levels that has at most this many rows
+    (coarsest if none has)
+    :return: DataFrame indexed by the raw row number(first row of the group for rollups)
+    """
+    meta = get_meta(store_dir)
+    if level is None:
+        levels = [lv for lv in get_levels(store_dir) if lv != 'epoch']
+        level = levels[-1]
+        for lv in levels:
+            key = meta['columns'][0] if lv == 'raw' else 'ROW'
+            if max_rows is None or _num_rows(store_dir, lv, [key], dict(meta['dtypes'], ROW='<i8')) <= max_rows:
+                level = lv
+                break
+
+    dtypes = dict(meta['dtypes'], ROW='<i8', COUNT='<i8')
+    if columns is None:
+        columns = [c for c in meta['columns'] if level == 'raw' or dtypes[c] != _TEXT]
+    if level != 'raw':
+        columns = [c for c in columns if c not in ['ROW', 'COUNT']] + ['COUNT']
+    read = columns + (['ROW'] if level != 'raw' else [])
+    n = _num_rows(store_dir, level, read, dtypes)
+
+    data = {}
+    for c in read:
+        arr = np.fromfile(os.path.join(store_dir, level, c + '.bin'), dtype=dtypes[c], count=n)
+        data[c] = np.char.decode(arr, 'utf-8') if dtypes[c] == _TEXT else arr
+    index = data.pop('ROW') if level != 'raw' else np.arange(n)
+    return pd.DataFrame(data, columns=columns, index=pd.Index(index))
+
+
+def export_csv(store_dir=None, csv_file=None, level='raw'):
+    """
+    Write one level of the store as csv(numbers that are all whole are written as integers)
+    :param store_dir: Store directory
+    :param csv_file: File to write, default <store name>-<level>.csv next to the store
+    :param level: 'raw', 'r<N>' or 'epoch'
+    :return: csv file written
+    """
+    df = read_metrics(store_dir, level=level)
+    for c in df.columns:
+        if df[c].dtype.kind == 'f' and np.isfinite(df[c]).all() and (df[c] % 1 == 0).all():
+            df[c] = df[c].astype(np.int64)
+    if csv_file is None:
+        # Never the name of the csv train log(X-TRAIN.csv) the store stands in for
+        csv_file = store_dir.rstrip(os.sep).rsplit('.', 1)[0] + '-' + level + '.csv'
+    df.to_csv(csv_file, index=level != 'raw', index_label='ROW')
+    return csv_file
+
+
+if __name__ == "__main__":
+    # Usage(from the repo root): python -m nbee.metricstore logs/DRIVE/DRIVE-TRAIN.metrics [raw|r100|r1000|epoch]
+    print('### Exported ' + export_csv(store_dir=sys.argv[1], level=sys.argv[2] if len(sys.argv) > 2 else 'raw'))
@@ -0,0 +1,106 @@
+"""
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import threading
+import time
+from queue import Queue
+
+import torch
+
+_END = object()
+
+
+class BatchPrefetcher:
+    """
+    Wraps a DataLoader so that the next batches are fetched and moved to the device by a background thread while the
+    current step runs. On a gpu the copies(non_blocking, from pinned memory) run on their own cuda stream.
+    Time the consumer spends waiting for a batch is summed up in wait_time, also with depth=0(no prefetching).
+    """
+
+    def __init__(self, data_loader=None, to_device=None, depth=2, device=None):
+        """
+        :param data_loader: Any iterable of batches(DataLoader, PhaseLoader...)
+        :param to_device: f(batch) -> batch on the device
+        :param depth: Number of batches to stage ahead. 0 fetches in the consuming thread.
+        :param device: Device that to_device copies to. Only a cuda device gets a copy stream.
+        """
+        self.data_loader = data_loader
+        self.to_device = to_device
+        self.depth = depth
+        self.device = torch.device(device) if device is not None else torch.device('cpu')
+        self.wait_time = 0.0
+        self.steps = 0
+
+    @property
+    def dataset(self):
+        return self.data_loader.dataset
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def _stage(self, data, stream):
+        if stream is None:
+            return self.to_device(data), None
+        with torch.cuda.stream(stream):
+            data = self.to_device(data)
+            event = torch.cuda.Event()
+            event.record(stream)
+        return data, event
+
+    def _fill(self, queue, stream, stop):
+        try:
+            for data in self.data_loader:
+                if stop.is_set():
+                    return
+                queue.put(self._stage(data, stream))
+            queue.put((_END, None))
+        except Exception as e:
+            queue.put((e, None))
+
+    def __iter__(self):
+        self.wait_time, self.steps = 0.0, 0
+        if self.depth <= 0:
+            batches = iter(self.data_loader)
+            while True:
+                start = time.time()
+                data = next(batches, _END)
+                self.wait_time += time.time() - start
+                if data is _END:
+                    return
+                self.steps += 1
+                yield self.to_device(data)
+
+        stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+        queue, stop = Queue(maxsize=self.depth), threading.Event()
+        worker = threading.Thread(target=self._fill, args=(queue, stream, stop), daemon=True)
+        worker.start()
+        try:
+            while True:
+                start = time.time()
+                data, event = queue.get()
+                self.wait_time += time.time() - start
+                if data is _END:
+                    return
+                if isinstance(data, Exception):
+                    raise data
+                if event is not None:
+                    # Wait for the copies, and keep the staged memory alive until the compute stream is done with it
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    for v in data.values():
+                        if isinstance(v, torch.Tensor) and v.is_cuda:
+                            v.record_stream(torch.cuda.current_stream(self.device))
+                self.steps += 1
+                yield data
+        finally:
+            # Consumer stopped early(eg. early stop, exception), let the thread drain out
+            stop.set()
+            while worker.is_alive():
+                while not queue.empty():
+                    queue.get()
+                worker.join(0.1)
+
+    def get_wait_per_step(self):
+        return self.wait_time / max(self.steps, 1)
@@ -0,0 +1,95 @@
+"""
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import atexit
+import mmap
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+def _attach(file, dtype, shape, offset=0):
+    return SharedArray(file, dtype=np.dtype(dtype), mode='r', shape=shape, offset=offset)
+
+
+class SharedArray(np.memmap):
+    """
+    Read only memory mapped array that pickles as a reference to its backing file.
+    A DataLoader worker receiving it(spawn/forkserver) maps the same pages instead of getting its own copy.
+    Views and copies pickle as ordinary arrays.
+    """
+
+    def __reduce__(self):
+        if isinstance(self.base, mmap.mmap):
+            return _attach, (self.filename, self.dtype.str, self.shape, self.offset)
+        return np.asarray(self).__reduce__()
+
+
+class SharedArrayStore:
+    """
+    Moves arrays into files under /dev/shm(temp dir if not available) and hands back SharedArray views of them.
+    The files are removed by the process that created the store on close() or at exit. Stores left behind by
+    processes that no longer run(eg. killed) are removed when a new store is created.
+    """
+
+    def __init__(self, store_dir=None):
+        if store_dir is None:
+            store_dir = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+        SharedArrayStore._remove_stale(store_dir)
+        self.store_dir = tempfile.mkdtemp(prefix='nbee-' + str(os.getpid()) + '-', dir=store_dir)
+        self._owner = os.getpid()
+        self._count = 0
+        atexit.register(self.close)
+
+    @staticmethod
+    def _remove_stale(store_dir):
+        for name in os.listdir(store_dir):
+            parts = name.split('-')
+            if len(parts) < 3 or parts[0] != 'nbee' or not parts[1].isdigit():
+                continue
+            try:
+                os.kill(int(parts[1]), 0)
+            except ProcessLookupError:
+                shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+            except OSError:
+                pass
+
+    def share(self, arr):
+        """
+        :param arr: numpy array
+        :return: SharedArray with the content of arr. Anything that cannot be mapped is returned as it is.
+        """
+        if not isinstance(arr, np.ndarray) or isinstance(arr, SharedArray) or arr.size == 0 or arr.dtype.hasobject:
+            return arr
+        file = os.path.join(self.store_dir, str(self._count) + '.bin')
+        self._count += 1
+        mm = np.memmap(file, dtype=arr.dtype, mode='w+', shape=arr.shape)
+        mm[...] = arr
+        mm.flush()
+        del mm
+        return _attach(file, arr.dtype.str, arr.shape)
+
+    def share_image(self, img_obj):
+        """
+        Replace all arrays of an utils.img_utils.Image, including the ones in extra, with shared ones.
+        :param img_obj: Image object
+        :return: Same image object
+        """
+        img_obj.image_arr = self.share(img_obj.image_arr)
+        img_obj.working_arr = self.share(img_obj.working_arr)
+        img_obj.mask = self.share(img_obj.mask)
+        img_obj.ground_truth = self.share(img_obj.ground_truth)
+        for k, v in img_obj.extra.items():
+            img_obj.extra[k] = self.share(v)
+        return img_obj
+
+    def close(self):
+        # Arrays already mapped stay readable, only the files go away
+        if os.getpid() == self._owner:
+            shutil.rmtree(self.store_dir, ignore_errors=True)
+            atexit.unregister(self.close)
@@ -12,11 +12,27 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 
+import nbee.distributed as ddp
+from nbee.csvlogger import CSVLogger
+from nbee.metricstore import MetricsLogger
+from nbee.prefetch import BatchPrefetcher
 from utils.loss import dice_loss as l
 from utils.measurements import ScoreAccumulator
+from viz.plotservice import get_plot_service
+
+
+class _RowBuffer(list):
+    """
+    Stands in for the log of a rank that does not write one(see NNBee.flush), keeps the rows to gather on rank 0.
+    """
+
+    def write(self, msg):
+        self.append(msg)
 
 
 class NNBee:
+    # uint8 inputs are cast to float and divided by this on the device(255.0 does what torchvision ToTensor does)
+    input_divisor = 1.0
 
     def __init__(self, conf=None, model=None, optimizer=None):
 
@@ -31,13 +47,25 @@ class NNBee:
         # Initialize necessary logging conf
         self.checkpoint_file = os.path.join(self.log_dir, self.conf.get('checkpoint_file'))
 
+        # Only rank 0 of a distributed run logs
+        self.is_master = ddp.is_master()
+
+        # Figures of the logs are drawn by a separate(spawned) process, see viz.plotservice
+        self.plotter = None
+        if self.is_master:
+            self.plotter = get_plot_service(in_process=not self.conf.get('Params').get('plot_process', True))
         self.log_headers = self.get_log_headers()
         _log_key = self.conf.get('checkpoint_file').split('.')[0]
-        self.test_logger = NNBee.get_logger(log_file=os.path.join(self.log_dir, _log_key + '-TEST.csv'),
-                                            header=self.log_headers.get('test', ''))
-        if self.mode == 'train':
-            self.train_logger = NNBee.get_logger(log_file=os.path.join(self.log_dir, _log_key + '-TRAIN.csv'),
-                                                 header=self.log_headers.get('train', ''))
+        self.test_logger, self.train_logger, self.val_logger = None, None, None
+        if self.is_master:
+            self.test_logger = NNBee.get_logger(log_file=os.path.join(self.log_dir, _log_key + '-TEST.csv'),
+                                                header=self.log_headers.get('test', ''))
+        if self.is_master and self.mode == 'train':
+            # Per batch train log goes to a columnar store(see nbee/metricstore.py) instead of a csv, if asked
+            store = self.conf.get('Params').get('metrics_store', False)
+            self.train_logger = NNBee.get_logger(
+                log_file=os.path.join(self.log_dir, _log_key + ('-TRAIN.metrics' if store else '-TRAIN.csv')),
+                header=self.log_headers.get('train', ''), store=store)
             self.val_logger = NNBee.get_logger(log_file=os.path.join(self.log_dir, _log_key + '-VAL.csv'),
                                                header=self.log_headers.get('validation', ''))
 
@@ -46,6 +74,11 @@ class NNBee:
         if not self.dparm:
             self.dparm = lambda x: [1.0, 1.0]
 
+        # Function to augment a whole batch of training inputs and labels, default is no augmentation
+        self.augment = self.conf.get("Funcs").get('augment')
+        if not self.augment:
+            self.augment = lambda inputs, labels: (inputs, labels)
+
         # Handle gpu/cpu
         if torch.cuda.is_available():
             self.device = torch.device("cuda" if self.conf['Params'].get('use_gpu', False) else "cpu")
@@ -60,13 +93,19 @@ class NNBee:
         self.checkpoint = {'total_epochs:': 0, 'epochs': 0, 'state': None, 'score': 0.0, 'model': 'EMPTY'}
         self.patience = self.conf.get('Params').get('patience', 35)
 
-    def test(self, data_loaders=None, gen_images=True):
+        # Number of batches to stage on the device ahead of the running step, 0 to turn off
+        self.prefetch_batches = self.conf.get('Params').get('prefetch_batches', 2)
+
+    def test(self, data_loader=None, gen_images=True):
         print('Running test')
         self.model.eval()
         score = ScoreAccumulator()
-        self._eval(data_loaders=data_loaders, gen_images=gen_images, score_acc=score, logger=self.test_logger)
-        self._on_test_end(log_file=self.test_logger.name)
-        if not self.test_logger and not self.test_logger.closed:
+        self._eval(data_loader=self.prefetch(data_loader), gen_images=gen_images, score_acc=score,
+                   logger=self.test_logger)
+        if self.is_master:
+            self.test_logger.flush()
+            self._on_test_end(log_file=self.test_logger.name)
+        if self.test_logger is not None and not self.test_logger.closed:
             self.test_logger.close()
 
     def _on_test_end(self, **kw):
@@ -78,25 +117,42 @@ class NNBee:
             self._adjust_learning_rate(epoch=epoch)
             self.checkpoint['total_epochs'] = epoch
 
+            # Distributed sampler shuffles by epoch
+            if hasattr(getattr(data_loader, 'sampler', None), 'set_epoch'):
+                data_loader.sampler.set_epoch(epoch)
+
             # Run one epoch
-            epoch_run(epoch=epoch, data_loader=data_loader)
+            train_loader = self.prefetch(data_loader)
+            epoch_run(epoch=epoch, data_loader=train_loader)
+            print('Data wait per batch: %.2f ms' % (train_loader.get_wait_per_step() * 1000))
 
-            self._on_epoch_end(data_loader=data_loader, log_file=self.train_logger.name)
+            if self.is_master:
+                self.train_logger.flush()
+                self._on_epoch_end(data_loader=data_loader, log_file=self.train_logger.name)
 
             # Validation_frequency is the number of epoch until validation
             if epoch % self.validation_frequency == 0:
                 print('Running validation..')
                 self.model.eval()
                 val_score = ScoreAccumulator()
-                self._eval(data_loaders=validation_loader, gen_images=False, score_acc=val_score,
-                           logger=self.val_logger)
-                self._on_validation_end(data_loader=validation_loader, log_file=self.val_logger.name)
+                # Ranks validate different images: each keeps its per image rows, rank 0 logs the rows of all
+                val_rows = _RowBuffer() if ddp.is_distributed() else self.val_logger
+                self._eval(data_loader=self.prefetch(validation_loader), gen_images=False, score_acc=val_score,
+                           logger=val_rows)
+                if ddp.is_distributed():
+                    val_rows = ddp.all_gather_list(list(val_rows))
+                    if self.is_master:
+                        for row in val_rows:
+                            self.val_logger.write(row)
+                if self.is_master:
+                    self.val_logger.flush()
+                    self._on_validation_end(data_loader=validation_loader, log_file=self.val_logger.name)
                 if self.early_stop(patience=self.patience):
-                    return
+                    break
 
-        if not self.train_logger and not self.train_logger.closed:
+        if self.train_logger is not None and not self.train_logger.closed:
             self.train_logger.close()
-        if not self.val_logger and not self.val_logger.closed:
+        if self.val_logger is not None and not self.val_logger.closed:
             self.val_logger.close()
 
     def _on_epoch_end(self, **kw):
@@ -114,9 +170,63 @@ class NNBee:
         # }
         raise NotImplementedError('Must be implemented to use.')
 
-    def _eval(self, data_loaders=None, logger=None, gen_images=False, score_acc=None):
+    def _eval(self, data_loader=None, logger=None, gen_images=False, score_acc=None):
         return NotImplementedError('------Evaluation step can vary a lot.. Needs to be implemented.-------')
 
+    def _eval_per_image(self, data_loader=None, on_image_start=None, on_patch=None, on_image_end=None):
+        """
+        Runs the model over one loader of patches from many images(see Generator.get_eval_loader) and hands over the
+        results image by image. Patches of an image must come one after another, as they do with shuffle off.
+        :param data_loader: Evaluation loader with 'id' of the image in each sample
+        :param on_image_start: f(img_obj) -> state, called before the first patch of each image
+        :param on_patch: f(state, data, outputs, j), called for j-th sample of each batch
+        :param on_image_end: f(img_obj, state), called after the last patch of each image
+        """
+        image_objects = data_loader.dataset.image_objects
+        # Ranks evaluate different images, so no collective calls of DistributedDataParallel here
+        model = self.model.module if isinstance(self.model, torch.nn.parallel.DistributedDataParallel) else self.model
+        ID, img_obj, state = None, None, None
+        with torch.no_grad():
+            for i, data in enumerate(data_loader, 1):
+                outputs = model(self._inputs_to_device(data['inputs']))
+                for j, patch_id in enumerate(data['id'].tolist()):
+                    if patch_id != ID:
+                        if img_obj is not None:
+                            on_image_end(img_obj, state)
+                        ID, img_obj = patch_id, image_objects[patch_id]
+                        state = on_image_start(img_obj)
+                    on_patch(state, data, outputs, j)
+                print('Batch: ', i, end='\r')
+            if img_obj is not None:
+                on_image_end(img_obj, state)
+
+    def _inputs_to_device(self, inputs):
+        """
+        Batches travel from the loader workers(and through pinned memory) in their compact dtype, mostly uint8.
+        They only become float here, on the device.
+        :param inputs: Collated batch of inputs
+        :return: float tensor on the device
+        """
+        inputs = inputs.to(self.device, non_blocking=True)
+        if inputs.dtype == torch.uint8:
+            return inputs.float().div(self.input_divisor)
+        return inputs.float()
+
+    def _batch_to_device(self, data):
+        # Only inputs and labels go to the device, 'id' and 'clip_ix' are read on the host
+        data['inputs'] = self._inputs_to_device(data['inputs'])
+        if 'labels' in data:
+            data['labels'] = data['labels'].to(self.device, non_blocking=True)
+        return data
+
+    def prefetch(self, data_loader=None):
+        """
+        :param data_loader: Loader to wrap
+        :return: BatchPrefetcher that yields batches already on the device(see _batch_to_device)
+        """
+        return BatchPrefetcher(data_loader=data_loader, to_device=self._batch_to_device, depth=self.prefetch_batches,
+                               device=self.device)
+
     def resume_from_checkpoint(self, parallel_trained=False):
         try:
             if parallel_trained:
@@ -144,7 +254,8 @@ class NNBee:
             self.checkpoint['epochs'] = self.checkpoint['total_epochs']
             self.checkpoint['score'] = score
             self.checkpoint['model'] = str(self.model)
-            torch.save(self.checkpoint, self.checkpoint_file)
+            if self.is_master:
+                torch.save(self.checkpoint, self.checkpoint_file)
         else:
             print('Score did not improve:' + str(score) + ' BEST: ' + str(self.checkpoint['score']) + ' EP: ' + (
                 str(self.checkpoint['epochs'])))
@@ -153,23 +264,23 @@ class NNBee:
         return self.checkpoint['total_epochs'] - self.checkpoint['epochs'] >= patience * self.validation_frequency
 
     @staticmethod
-    def get_logger(log_file=None, header=''):
+    def get_logger(log_file=None, header='', store=False):
 
-        if os.path.isfile(log_file):
+        if os.path.exists(log_file):
             print('### CRITICAL!!! ' + log_file + '" already exists.')
             ip = input('Override? [Y/N]: ')
             if ip == 'N' or ip == 'n':
                 sys.exit(1)
 
-        file = open(log_file, 'w')
-        NNBee.flush(file, header)
-        return file
+        if store:
+            return MetricsLogger(log_file=log_file, header=header)
+        return CSVLogger(log_file=log_file, header=header)
 
     @staticmethod
     def flush(logger, msg):
+        # Only buffered, the logger writes to disk in background(see CSVLogger)
         if logger is not None:
             logger.write(msg + '\n')
-            logger.flush()
 
     def _adjust_learning_rate(self, epoch):
         if epoch % 30 == 0:
@@ -177,20 +288,17 @@ class NNBee:
                 if param_group['lr'] >= 1e-5:
                     param_group['lr'] = param_group['lr'] * 0.7
 
-    @staticmethod
-    def plot_column_keys(file, batches_per_epoch, title='', keys=[]):
+    def plot_column_keys(self, file, batches_per_epoch, title='', keys=[]):
         """
-        This method plots all desired columns, specified in key, from log file
+        This method plots all desired columns, specified in key, from log file(in background, see viz.plotservice)
         :param file:
         :param batches_per_epoch:
         :param title:
         :param keys:
         :return:
         """
-        from viz.nviz import plot
         for k in keys:
-            plot(file=file, title=title, y=k, save=True,
-                 x_tick_skip=batches_per_epoch)
+            self.plotter.submit('plot', file=file, title=title, y=k, save=True, x_tick_skip=batches_per_epoch)
 
     '''
     ######################################################################################
@@ -199,16 +307,35 @@ class NNBee:
     ######################################################################################
     '''
 
+    def _log_batch_scores(self, batch_rows, **kw):
+        """
+        Write the buffered per batch rows(batch number, loss tensor, [tn, fp, fn, tp] tensor) to the train log,
+        pulling them from the device at once
+        """
+        losses = torch.stack([loss for _, loss, _ in batch_rows]).tolist()
+        counts = torch.stack([c for _, _, c in batch_rows]).tolist()
+        for (i, _, _), current_loss, (tn, fp, fn, tp) in zip(batch_rows, losses, counts):
+            p, r, f1, a = ScoreAccumulator().add(tn=tn, fp=fp, fn=fn, tp=tp).get_prfa()
+            self.flush(self.train_logger, ','.join(str(x) for x in [0, kw['epoch'], i, p, r, f1, a, current_loss]))
+
+        if batch_rows[-1][0] % self.log_frequency == 0:
+            print('Epochs[%d/%d] Batch[%d/%d] loss:%.5f pre:%.3f rec:%.3f f1:%.3f acc:%.3f' %
+                  (
+                      kw['epoch'], self.epochs, batch_rows[-1][0], kw['data_loader'].__len__(),
+                      sum(losses) / self.log_frequency, p, r, f1,
+                      a))
+
     def epoch_ce_loss(self, **kw):
         """
         One epoch implementation of binary cross-entropy loss
         :param kw:
         :return:
         """
-        running_loss = 0.0
-        score_acc = ScoreAccumulator()
+        batch_rows = []
         for i, data in enumerate(kw['data_loader'], 1):
-            inputs, labels = data['inputs'].to(self.device).float(), data['labels'].to(self.device).long()
+            inputs = self._inputs_to_device(data['inputs'])
+            labels = data['labels'].to(self.device, non_blocking=True).long()
+            inputs, labels = self.augment(inputs, labels)
             self.optimizer.zero_grad()
             outputs = self.model(inputs)
             _, predicted = torch.max(outputs, 1)
@@ -217,25 +344,20 @@ class NNBee:
             loss.backward()
             self.optimizer.step()
 
-            current_loss = loss.item()
-            running_loss += current_loss
-            p, r, f1, a = score_acc.reset().add_tensor(predicted, labels).get_prfa()
-
+            # Loss and counts stay on the device until the rows are logged
+            batch_rows.append((i, loss.detach(), ScoreAccumulator.get_tensor_counts(predicted, labels)))
             if i % self.log_frequency == 0:
-                print('Epochs[%d/%d] Batch[%d/%d] loss:%.5f pre:%.3f rec:%.3f f1:%.3f acc:%.3f' %
-                      (
-                          kw['epoch'], self.epochs, i, kw['data_loader'].__len__(),
-                          running_loss / self.log_frequency, p, r, f1,
-                          a))
-                running_loss = 0.0
-            self.flush(self.train_logger,
-                       ','.join(str(x) for x in [0, kw['epoch'], i, p, r, f1, a, current_loss]))
+                self._log_batch_scores(batch_rows, **kw)
+                batch_rows = []
+        if batch_rows:
+            self._log_batch_scores(batch_rows, **kw)
 
     def epoch_dice_loss(self, **kw):
-        score_acc = ScoreAccumulator()
-        running_loss = 0.0
+        batch_rows = []
         for i, data in enumerate(kw['data_loader'], 1):
-            inputs, labels = data['inputs'].to(self.device).float(), data['labels'].to(self.device).long()
+            inputs = self._inputs_to_device(data['inputs'])
+            labels = data['labels'].to(self.device, non_blocking=True).long()
+            inputs, labels = self.augment(inputs, labels)
             # weights = data['weights'].to(self.device)
 
             self.optimizer.zero_grad()
@@ -250,23 +372,20 @@ class NNBee:
             loss.backward()
             self.optimizer.step()
 
-            current_loss = loss.item()
-            running_loss += current_loss
-            p, r, f1, a = score_acc.reset().add_tensor(predicted, labels).get_prfa()
+            # Loss and counts stay on the device until the rows are logged
+            batch_rows.append((i, loss.detach(), ScoreAccumulator.get_tensor_counts(predicted, labels)))
             if i % self.log_frequency == 0:
-                print('Epochs[%d/%d] Batch[%d/%d] loss:%.5f pre:%.3f rec:%.3f f1:%.3f acc:%.3f' %
-                      (
-                          kw['epoch'], self.epochs, i, kw['data_loader'].__len__(), running_loss / self.log_frequency,
-                          p, r, f1,
-                          a))
-                running_loss = 0.0
-
-            self.flush(self.train_logger, ','.join(str(x) for x in [0, kw['epoch'], i, p, r, f1, a, current_loss]))
+                self._log_batch_scores(batch_rows, **kw)
+                batch_rows = []
+        if batch_rows:
+            self._log_batch_scores(batch_rows, **kw)
 
     def epoch_mse_loss(self, **kw):
         running_loss = 0.0
         for i, data in enumerate(kw['data_loader'], 1):
-            inputs, labels = data['inputs'].to(self.device).float(), data['labels'].to(self.device).float()
+            inputs = self._inputs_to_device(data['inputs'])
+            labels = data['labels'].to(self.device, non_blocking=True).float()
+            inputs, labels = self.augment(inputs, labels)
 
             self.optimizer.zero_grad()
             outputs = self.model(inputs)
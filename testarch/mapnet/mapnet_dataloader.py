@@ -5,22 +5,67 @@
 """
 
 import os
-from random import shuffle
 
 import numpy as np
-import torch
-import torchvision.transforms as tfm
 from skimage.morphology import skeletonize
 
 import utils.img_utils as iu
-from utils.img_utils import Image
+from nbee.datacache import ArrayCache
 from nbee.datagen import Generator
-import random
 
 sep = os.sep
 
 
+def get_seed_maps(unet_map=None, ground_truth=None, sup=20, res=235, comp_limit=10, grid=None):
+    """
+    MapNet preprocessing of an UNet probability map. Pixels above res are taken as vessels(fill_in), pixels below
+    sup as background, and the ones in between(mid_pix, gt_mid) are left for the MapNet to decide.
+    :param unet_map: UNet probability map(uint8)
+    :param ground_truth: Ground truth of the image
+    :param sup: Lower threshold
+    :param res: Upper threshold
+    :param comp_limit: Connected components of smaller diameter are removed before skeletonize
+    :param grid: Spacing of the grid that seeds are picked along
+    :return: dict of arrays fill_in, mid_pix, gt_mid, seed
+    """
+    fill_in = np.zeros_like(unet_map)
+    fill_in[unet_map > res] = 1
+
+    mid_pix = unet_map.copy()
+    mid_pix[mid_pix < sup] = 0
+    mid_pix[mid_pix > res] = 0
+
+    gt_mid = ground_truth.copy()
+    gt_mid[unet_map > res] = 0
+    gt_mid[unet_map < sup] = 0
+
+    # <PREP1> Segment with a low threshold and get a raw segmented image
+    raw_estimate = unet_map.copy()
+    raw_estimate[raw_estimate > sup] = 255
+    raw_estimate[raw_estimate <= sup] = 0
+
+    # <PREP2> Clear up small components(components less that 20px)
+    raw_estimate = iu.remove_connected_comp(raw_estimate.squeeze(), comp_limit)
+
+    # <PREP3> Skeletonize binary image
+    seed = raw_estimate.copy()
+    seed[seed == 255] = 1
+    seed = skeletonize(seed).astype(np.uint8)
+
+    # <PREP4> Come up with a grid mask to select few possible pixels to reconstruct the vessels from
+    sk_mask = np.zeros_like(seed)
+    sk_mask[::grid] = 1
+    sk_mask[:, ::grid] = 1
+
+    # <PREP5> Apply mask and save seed
+    return {'fill_in': fill_in, 'mid_pix': mid_pix, 'gt_mid': gt_mid, 'seed': seed * sk_mask * 255}
+
+
 class PatchesGenerator(Generator):
+    # Seed preprocessing(connected components, skeletonize, see get_seed_maps) holds the GIL
+    load_pool = 'process'
+    eval_batch_size = 16
+
     def __init__(self, **kwargs):
         super(PatchesGenerator, self).__init__(**kwargs)
         self.patch_shape = self.conf.get('Params').get('patch_shape')
@@ -28,79 +73,54 @@ class PatchesGenerator(Generator):
         self.patch_offset = self.conf.get('Params').get('patch_offset')
         self.unet_dir = self.conf['Dirs']['image_unet']
         self.input_image_ext = '.png'
+        self.seed_sup = self.conf.get('Params').get('seed_sup', 20)
+        self.seed_res = self.conf.get('Params').get('seed_res', 235)
+        self.seed_comp_limit = self.conf.get('Params').get('seed_comp_limit', 10)
+        self.seed_grid = self.conf.get('Params').get('seed_grid', int(0.6 * self.patch_shape[0]))
         self._load_indices()
         print('Patches:', self.__len__())
 
     def _load_indices(self):
-        for ID, img_file in enumerate(self.images):
-
-            img_obj = self._get_image_obj(img_file)
-            all_pix_pos = list(zip(*np.where(img_obj.extra['seed'] == 255)))
-            all_patch_indices = list(
-                iu.get_chunk_indices_by_index(img_obj.working_arr.shape, self.patch_shape, all_pix_pos))
-            # all_patch_indices = list(
-            #     iu.get_chunk_indexes(img_obj.working_arr.shape, self.patch_shape, self.patch_shape))
-            for chunk_ix in all_patch_indices:
-                self.indices.append([ID] + chunk_ix)
+        tables = [self.indices]
+        for ID, img_obj in self._load_image_objects():
+            all_pix_pos = np.argwhere(img_obj.extra['seed'] == 255)
+            all_patch_indices = iu.get_chunk_indices_by_index_array(img_obj.working_arr.shape, self.patch_shape,
+                                                                    all_pix_pos)
+            # all_patch_indices = iu.get_chunk_indexes_array(img_obj.working_arr.shape, self.patch_shape,
+            #                                                self.patch_shape)
+            tables.append(self._index_table(ID, all_patch_indices))
             self.image_objects[ID] = img_obj
+        self.indices = np.concatenate(tables)
         if self.shuffle_indices:
-            shuffle(self.indices)
+            self._shuffle_indices()
 
     def _get_image_obj(self, img_file=None):
-        img_obj = Image()
-        img_obj.load_file(data_dir=self.image_dir, file_name=img_file)
-        if self.mask_getter is not None:
-            img_obj.load_mask(mask_dir=self.mask_dir, fget_mask=self.mask_getter)
-        if self.truth_getter is not None:
-            img_obj.load_ground_truth(gt_dir=self.truth_dir, fget_ground_truth=self.truth_getter)
-
-        img_obj.working_arr = img_obj.image_arr[:, :, 1]
-        img_obj.apply_clahe()
-        img_obj.apply_mask()
-
-        sup, res = 20, 235
-
-        img_obj.extra['unet'] = iu.get_image_as_array(
-            self.unet_dir + sep + img_obj.file_name.split('.')[0] + self.input_image_ext, 1)
-
-        img_obj.extra['indices'] = list(zip(*np.where((img_obj.extra['unet'] >= sup) & (img_obj.extra['unet'] <= res))))
-
-        img_obj.extra['fill_in'] = np.zeros_like(img_obj.working_arr)
-        img_obj.extra['fill_in'][img_obj.extra['unet'] > res] = 1
-
-        img_obj.extra['mid_pix'] = img_obj.extra['unet'].copy()
-        img_obj.extra['mid_pix'][img_obj.extra['mid_pix'] < sup] = 0
-        img_obj.extra['mid_pix'][img_obj.extra['mid_pix'] > res] = 0
-
-        img_obj.extra['gt_mid'] = img_obj.ground_truth.copy()
-        img_obj.extra['gt_mid'][img_obj.extra['unet'] > res] = 0
-        img_obj.extra['gt_mid'][img_obj.extra['unet'] < sup] = 0
-
-        # <PREP1> Segment with a low threshold and get a raw segmented image
-        raw_estimate = img_obj.extra['unet'].copy()
-        raw_estimate[raw_estimate > sup] = 255
-        raw_estimate[raw_estimate <= sup] = 0
-
-        # <PREP2> Clear up small components(components less that 20px)
-        raw_estimate = iu.remove_connected_comp(raw_estimate.squeeze(), 10)
-
-        # <PREP3> Skeletonize binary image
-        seed = raw_estimate.copy()
-        seed[seed == 255] = 1
-        seed = skeletonize(seed).astype(np.uint8)
-
-        # <PREP4> Come up with a grid mask to select few possible pixels to reconstruct the vessels from
-        sk_mask = np.zeros_like(seed)
-        sk_mask[::int(0.6 * self.patch_shape[0])] = 1
-        sk_mask[:, ::int(0.6 * self.patch_shape[0])] = 1
-
-        # <PREP5> Apply mask and save seed
-        img_obj.extra['seed'] = seed * sk_mask * 255
-
+        # Files are hashed once, for the key of the image and for the key of its seed maps
+        img_key = self._get_cache_key(img_file, 1) if self.cache is not None else None
+        img_obj = super(PatchesGenerator, self)._get_image_obj(img_file, channel=1, key=img_key)
+
+        unet_file = self.unet_dir + sep + img_obj.file_name.split('.')[0] + self.input_image_ext
+        img_obj.extra['unet'] = iu.get_image_as_array(unet_file, 1)
+
+        key = None
+        if self.cache is not None:
+            key = ArrayCache.key('mapnet.seed', img_key, ArrayCache.file_digest(unet_file),
+                                 self.seed_sup, self.seed_res, self.seed_comp_limit, self.seed_grid)
+            cached = self.cache.get(key)
+            if cached is not None:
+                img_obj.extra.update(cached)
+                return img_obj
+
+        seed_maps = get_seed_maps(unet_map=img_obj.extra['unet'], ground_truth=img_obj.ground_truth,
+                                  sup=self.seed_sup, res=self.seed_res, comp_limit=self.seed_comp_limit,
+                                  grid=self.seed_grid)
+        if key is not None:
+            self.cache.put(key, seed_maps)
+        img_obj.extra.update(seed_maps)
         return img_obj
 
     def __getitem__(self, index):
-        ID, row_from, row_to, col_from, col_to = self.indices[index]
+        ID, row_from, row_to, col_from, col_to = self.indices[index].tolist()
 
         orig = self.image_objects[ID].working_arr
         unet_map = 255 - self.image_objects[ID].extra['unet']
@@ -114,19 +134,7 @@ class PatchesGenerator(Generator):
         mid_patch = np.pad(mid_pix[p:q, r:s], pad, 'reflect')
         unet_patch = np.pad(unet_map[p:q, r:s], pad, 'reflect')
 
-        if self.mode == 'train' and random.uniform(0, 1) <= 0.5:
-            orig_patch = np.flip(orig_patch, 0)
-            unet_patch = np.flip(unet_patch, 0)
-            mid_patch = np.flip(mid_patch, 0)
-            y_mid = np.flip(y_mid, 0)
-
-        if self.mode == 'train' and random.uniform(0, 1) <= 0.5:
-            orig_patch = np.flip(orig_patch, 1)
-            unet_patch = np.flip(unet_patch, 1)
-            mid_patch = np.flip(mid_patch, 1)
-            y_mid = np.flip(y_mid, 1)
-
-        y_mid[y_mid == 255] = 1
+        y_mid = np.where(y_mid == 255, 1, y_mid)
         if self.conf['Params']['num_channels'] == 1:
             img_tensor = np.array([mid_patch])
         else:
@@ -136,19 +144,3 @@ class PatchesGenerator(Generator):
                 'inputs': img_tensor,
                 'labels': y_mid.copy(),
                 'clip_ix': np.array([row_from, row_to, col_from, col_to]), }
-
-    @classmethod
-    def get_loader_per_img(cls, images, conf, mode, transforms):
-        loaders = []
-        for file in images:
-            gen = cls(
-                conf=conf,
-                images=[file],
-                transforms=transforms,
-                shuffle_indices=False,
-                mode=mode
-            )
-            loader = torch.utils.data.DataLoader(gen, batch_size=min(16, gen.__len__()),
-                                                 shuffle=False, num_workers=3, sampler=None)
-            loaders.append(loader)
-        return loaders
@@ -5,13 +5,9 @@
 """
 
 import os
-from random import shuffle
 
 import utils.img_utils as imgutils
 import numpy as np
-import torch
-import torchvision.transforms as tfm
-from utils.img_utils import Image
 
 from nbee.datagen import Generator
 
@@ -29,26 +25,20 @@ class PatchesGenerator(Generator):
         print('Patches:', self.__len__())
 
     def _load_indices(self):
-        for ID, img_file in enumerate(self.images):
-
-            img_obj = self._get_image_obj(img_file)
+        tables = [self.indices]
+        for ID, img_obj in self._load_image_objects():
 
             img_shape = img_obj.working_arr.shape[0], img_obj.working_arr.shape[1]
 
-            for chunk_ix in imgutils.get_chunk_indexes(img_shape, self.patch_shape,
-                                                       self.patch_offset):
-                self.indices.append([ID] + chunk_ix)
+            tables.append(self._index_table(ID, imgutils.get_chunk_indexes_array(img_shape, self.patch_shape,
+                                                                                 self.patch_offset)))
             self.image_objects[ID] = img_obj
+        self.indices = np.concatenate(tables)
         if self.shuffle_indices:
-            shuffle(self.indices)
+            self._shuffle_indices()
 
     def _get_image_obj(self, img_file=None):
-        img_obj = Image()
-        img_obj.load_file(data_dir=self.image_dir, file_name=img_file)
-        if self.mask_getter is not None:
-            img_obj.load_mask(mask_dir=self.mask_dir, fget_mask=self.mask_getter)
-        if self.truth_getter is not None:
-            img_obj.load_ground_truth(gt_dir=self.truth_dir, fget_ground_truth=self.truth_getter)
+        img_obj = self._load_image_obj(img_file)
 
         # Input images has four channels
         if self.probe_mode == 'depth':
@@ -64,7 +54,7 @@ class PatchesGenerator(Generator):
         return img_obj
 
     def __getitem__(self, index):
-        ID, row_from, row_to, col_from, col_to = self.indices[index]
+        ID, row_from, row_to, col_from, col_to = self.indices[index].tolist()
 
         img_obj = self.image_objects[ID]
         img_shape = img_obj.working_arr.shape
@@ -77,8 +67,8 @@ class PatchesGenerator(Generator):
             y = img_obj.ground_truth[row_from:row_to, col_from:col_to]
 
         elif self.probe_mode == 'normal':
-            img_tensor = np.zeros((3, 572, 572))
-            y = np.zeros((3, self.patch_shape[0], self.patch_shape[1]))
+            img_tensor = np.zeros((3, 572, 572), dtype=img_obj.working_arr.dtype)
+            y = np.zeros((3, self.patch_shape[0], self.patch_shape[1]), dtype=img_obj.ground_truth.dtype)
             for i in range(img_shape[2]):
                 img_tensor[i, :, :] = np.pad(img_obj.working_arr[:, :, i][p:q, r:s], pad, 'reflect')
                 y[i, :, :] = img_obj.ground_truth[row_from:row_to, col_from:col_to, i]
@@ -100,19 +90,3 @@ class PatchesGenerator(Generator):
                 'inputs': img_tensor,
                 'labels': y.copy(),
                 'clip_ix': np.array([row_from, row_to, col_from, col_to]), }
-
-    @classmethod
-    def get_loader_per_img(cls, images, conf, mode, transforms):
-        loaders = []
-        for file in images:
-            gen = cls(
-                conf=conf,
-                images=[file],
-                transforms=transforms,
-                shuffle_indices=False,
-                mode=mode
-            )
-            loader = torch.utils.data.DataLoader(gen, batch_size=min(1, gen.__len__()),
-                                                 shuffle=False, num_workers=3, sampler=None)
-            loaders.append(loader)
-        return loaders
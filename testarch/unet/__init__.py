@@ -10,6 +10,8 @@ import traceback
 import torch
 import torch.optim as optim
 
+import nbee.distributed as ddp
+from nbee.datagen import close_loaders
 from utils import auto_split as asp
 from utils.measurements import ScoreAccumulator
 from ..unet.model import UNet
@@ -19,40 +21,66 @@ from ..unet.unet_dataloader import PatchesGenerator
 
 def run(runs, transforms):
     for R in runs:
-        for k, folder in R['Dirs'].items():
-            os.makedirs(folder, exist_ok=True)
-        R['acc'] = ScoreAccumulator()
-        for split in os.listdir(R['Dirs']['splits_json']):
-            splits = asp.load_split_json(os.path.join(R['Dirs']['splits_json'], split))
-
-            R['checkpoint_file'] = split + '.tar'
-            model = UNet(R['Params']['num_channels'], R['Params']['num_classes'])
-            optimizer = optim.Adam(model.parameters(), lr=R['Params']['learning_rate'])
-            if R['Params']['distribute']:
-                model = torch.nn.DataParallel(model)
-                model.float()
-                optimizer = optim.Adam(model.module.parameters(), lr=R['Params']['learning_rate'])
-
-            try:
-                drive_trainer = UNetBee(model=model, conf=R, optimizer=optimizer)
-                if R.get('Params').get('mode') == 'train':
-                    train_loader = PatchesGenerator.get_loader(conf=R, images=splits['train'], transforms=transforms,
-                                                               mode='train')
-                    val_loader = PatchesGenerator.get_loader_per_img(conf=R, images=splits['validation'],
-                                                                     mode='validation', transforms=transforms)
-                    drive_trainer.train(data_loader=train_loader, validation_loader=val_loader,
-                                        epoch_run=drive_trainer.epoch_ce_loss)
-
-                drive_trainer.resume_from_checkpoint(parallel_trained=R.get('Params').get('parallel_trained'))
-
-                test_loader = PatchesGenerator.get_loader_per_img(conf=R,
-                                                                  images=splits['test'], mode='test',
-                                                                  transforms=transforms)
-                drive_trainer.test(test_loader)
-            except Exception as e:
-                traceback.print_exc()
-
-        print(R['acc'].get_prfa())
-        f = open(R['Dirs']['logs'] + os.sep + 'score.txt', "w")
-        f.write(', '.join(str(s) for s in R['acc'].get_prfa()))
-        f.close()
+        # Params['ddp']: train with this many processes(ranks) per host, see nbee.distributed.launch
+        if R['Params'].get('ddp'):
+            ddp.launch(_run, R, transforms, nprocs=R['Params']['ddp'])
+        else:
+            _run(R, transforms)
+
+
+def _run(R, transforms):
+    for k, folder in R['Dirs'].items():
+        os.makedirs(folder, exist_ok=True)
+    R['acc'] = ScoreAccumulator()
+
+    # One set of persistent loader workers for every phase of every split
+    pool = None
+    if R['Params'].get('loader_pool') and not ddp.is_distributed():
+        pool = PatchesGenerator.get_loader_pool(conf=R, transforms=transforms,
+                                                images=asp.get_split_images(R['Dirs']['splits_json']))
+    for split in os.listdir(R['Dirs']['splits_json']):
+        splits = asp.load_split_json(os.path.join(R['Dirs']['splits_json'], split))
+
+        R['checkpoint_file'] = split + '.tar'
+        model = UNet(R['Params']['num_channels'], R['Params']['num_classes'])
+        optimizer = optim.Adam(model.parameters(), lr=R['Params']['learning_rate'])
+        if R['Params']['distribute']:
+            model = torch.nn.DataParallel(model)
+            model.float()
+            optimizer = optim.Adam(model.module.parameters(), lr=R['Params']['learning_rate'])
+        if ddp.is_distributed():
+            model = torch.nn.parallel.DistributedDataParallel(model)
+
+        train_loader, val_loader, test_loader = None, None, None
+        try:
+            drive_trainer = UNetBee(model=model, conf=R, optimizer=optimizer)
+            if R.get('Params').get('mode') == 'train':
+                train_loader = PatchesGenerator.get_loader(conf=R, images=splits['train'], transforms=transforms,
+                                                           mode='train', pool=pool)
+                val_loader = PatchesGenerator.get_eval_loader(conf=R, images=splits['validation'],
+                                                              mode='validation', transforms=transforms, pool=pool)
+                drive_trainer.train(data_loader=train_loader, validation_loader=val_loader,
+                                    epoch_run=drive_trainer.epoch_ce_loss)
+
+            # Only rank 0 tests(writes images and logs)
+            if not ddp.is_master():
+                continue
+
+            drive_trainer.resume_from_checkpoint(parallel_trained=R.get('Params').get('parallel_trained'))
+
+            test_loader = PatchesGenerator.get_eval_loader(conf=R,
+                                                           images=splits['test'], mode='test',
+                                                           transforms=transforms, pool=pool)
+            drive_trainer.test(test_loader)
+        except Exception as e:
+            traceback.print_exc()
+        finally:
+            # Shared memory of the images of this split is not needed any more
+            close_loaders(train_loader, val_loader, test_loader)
+
+    if not ddp.is_master():
+        return
+    print(R['acc'].get_prfa())
+    f = open(R['Dirs']['logs'] + os.sep + 'score.txt', "w")
+    f.write(', '.join(str(s) for s in R['acc'].get_prfa()))
+    f.close()
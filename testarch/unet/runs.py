@@ -25,7 +25,8 @@ DRIVE = {
         'mask': 'data' + sep + 'DRIVE' + sep + 'mask',
         'truth': 'data' + sep + 'DRIVE' + sep + 'manual',
         'logs': 'logs' + sep + 'DRIVE',
-        'splits_json': 'data' + sep + 'DRIVE' + sep + 'splits'
+        'splits_json': 'data' + sep + 'DRIVE' + sep + 'splits',
+        'cache': 'data' + sep + 'DRIVE' + sep + 'cache'
     },
 
     'Funcs': {
@@ -7,17 +7,22 @@
 import numpy as np
 import os
 import torch
-import viz.nviz as plt
 from PIL import Image as IMG
+from nbee.augment import BatchAugmenter
 from nbee.torchbee import NNBee
-from utils.measurements import ScoreAccumulator
+from utils.measurements import CurveAccumulator, ScoreAccumulator
 
 sep = os.sep
 
 
 class UNetBee(NNBee):
+    # Patches come as uint8 without transforms, scale them to [0, 1] as ToTensor did
+    input_divisor = 255.0
+
     def __init__(self, **kwargs):
         NNBee.__init__(self, **kwargs)
+        if not self.conf.get('Funcs').get('augment'):
+            self.augment = BatchAugmenter()
         self.patch_shape = self.conf.get('Params').get('patch_shape')
         self.patch_offset = self.conf.get('Params').get('patch_offset')
 
@@ -32,64 +37,86 @@ class UNetBee(NNBee):
     def _on_epoch_end(self, **kw):
         self.plot_column_keys(file=kw['log_file'], batches_per_epoch=kw['data_loader'].__len__(),
                               keys=['F1', 'LOSS', 'ACCURACY'])
-        plt.plot_cmap(file=kw['log_file'], save=True, x='PRECISION', y='RECALL')
+        self.plotter.submit('plot_cmap', file=kw['log_file'], save=True, x='PRECISION', y='RECALL')
 
     def _on_validation_end(self, **kw):
-        self.plot_column_keys(file=kw['log_file'], batches_per_epoch=kw['data_loader'].__len__(),
+        self.plot_column_keys(file=kw['log_file'], batches_per_epoch=len(kw['data_loader'].dataset.images),
                               keys=['F1', 'ACCURACY'])
-        plt.plot_cmap(file=kw['log_file'], save=True, x='PRECISION', y='RECALL')
+        self.plotter.submit('plot_cmap', file=kw['log_file'], save=True, x='PRECISION', y='RECALL')
 
     def _on_test_end(self, **kw):
-        plt.y_scatter(file=kw['log_file'], y='F1', label='ID', save=True, title='Test')
-        plt.y_scatter(file=kw['log_file'], y='ACCURACY', label='ID', save=True, title='Test')
-        plt.xy_scatter(file=kw['log_file'], save=True, x='PRECISION', y='RECALL', label='ID', title='Test')
-
-    # This method takes torch n dataloaders for n image with one image in each and evaluates after training.
+        self.plotter.submit('y_scatter', file=kw['log_file'], y='F1', label='ID', save=True, title='Test')
+        self.plotter.submit('y_scatter', file=kw['log_file'], y='ACCURACY', label='ID', save=True, title='Test')
+        self.plotter.submit('xy_scatter', file=kw['log_file'], save=True, x='PRECISION', y='RECALL', label='ID',
+                            title='Test')
+
+    def _save_curves(self, curve_acc, img_curves):
+        """
+        Dataset level curves(thresholds, precision, recall, fpr), with AUCs and best F1 of all and of each image
+        """
+        roc_auc, pr_auc = curve_acc.get_auc()
+        best_f1, best_thr = curve_acc.get_best_f1()
+        np.savez(os.path.join(self.log_dir, self.conf.get('checkpoint_file').split('.')[0] + '-CURVES.npz'),
+                 roc_auc=roc_auc, pr_auc=pr_auc, best_f1=best_f1['F1'], best_thr=best_thr, **curve_acc.get_curves(),
+                 **{'image_' + k.lower(): np.array(v) for k, v in img_curves.items()})
+
+    # This method takes a torch dataloader over patches of all images and evaluates image by image after training.
     # It is also the base method for both testing and validation
-    def _eval(self, data_loaders=None, logger=None, gen_images=False, score_acc=None):
+    def _eval(self, data_loader=None, logger=None, gen_images=False, score_acc=None):
         assert isinstance(score_acc, ScoreAccumulator)
-        with torch.no_grad():
-            for loader in data_loaders:
-                img_obj = loader.dataset.image_objects[0]
-                x, y = img_obj.working_arr.shape[0], img_obj.working_arr.shape[1]
-                predicted_img = torch.FloatTensor(x, y).fill_(0).to(self.device)
-                map_img = torch.FloatTensor(x, y).fill_(0).to(self.device)
-
+        # PR/ROC curves of the probability maps, of each image and of all images
+        curve_acc = CurveAccumulator()
+        img_curves = {'ID': [], 'ROC_AUC': [], 'PR_AUC': [], 'BEST_F1': [], 'BEST_THR': []}
+
+        def on_image_start(img_obj):
+            x, y = img_obj.working_arr.shape[0], img_obj.working_arr.shape[1]
+            return {'predicted_img': torch.FloatTensor(x, y).fill_(0).to(self.device),
+                    'map_img': torch.FloatTensor(x, y).fill_(0).to(self.device)}
+
+        def on_patch(state, data, outputs, j):
+            p, q, r, s = data['clip_ix'][j].tolist()
+            _, predicted = torch.max(outputs[j], 0)
+            state['predicted_img'][p:q, r:s] = predicted
+            state['map_img'][p:q, r:s] = outputs[j, 1, :, :]
+
+        def on_image_end(img_obj, state):
+            img_score = ScoreAccumulator()
+            prob_img = torch.exp(state['map_img'])
+            map_img = prob_img * 255
+            predicted_img = state['predicted_img'] * 255
+
+            img_curve = CurveAccumulator().add_tensor(prob_img, torch.as_tensor(img_obj.ground_truth).to(self.device))
+            curve_acc.accumulate(img_curve)
+            best_f1, best_thr = img_curve.get_best_f1()
+            for k, v in zip(img_curves.keys(), [img_obj.file_name, *img_curve.get_auc(), best_f1['F1'], best_thr]):
+                img_curves[k].append(v)
+
+            if gen_images:
+                map_img = map_img.cpu().numpy()
+                predicted_img = predicted_img.cpu().numpy()
+                img_score.add_array(predicted_img, img_obj.ground_truth)
+                self.conf['acc'].accumulate(img_score)  # Global score
+
+                IMG.fromarray(np.array(predicted_img, dtype=np.uint8)).save(
+                    os.path.join(self.log_dir, 'pred_' + img_obj.file_name.split('.')[0] + '.png'))
+                IMG.fromarray(np.array(map_img, dtype=np.uint8)).save(
+                    os.path.join(self.log_dir, img_obj.file_name.split('.')[0] + '.png'))
+            else:
                 gt = torch.FloatTensor(img_obj.ground_truth).to(self.device)
-
-                for i, data in enumerate(loader, 1):
-                    inputs, labels = data['inputs'].to(self.device).float(), data['labels'].to(self.device).float()
-                    clip_ix = data['clip_ix'].to(self.device).int()
-
-                    outputs = self.model(inputs)
-                    _, predicted = torch.max(outputs, 1)
-                    predicted_map = outputs[:, 1, :, :]
-
-                    for j in range(predicted_map.shape[0]):
-                        p, q, r, s = clip_ix[j]
-                        predicted_img[p:q, r:s] = predicted[j]
-                        map_img[p:q, r:s] = predicted_map[j]
-                    print('Batch: ', i, end='\r')
-
-                img_score = ScoreAccumulator()
-                map_img = torch.exp(map_img) * 255
-                predicted_img = predicted_img * 255
-
-                if gen_images:
-                    map_img = map_img.cpu().numpy()
-                    predicted_img = predicted_img.cpu().numpy()
-                    img_score.add_array(predicted_img, img_obj.ground_truth)
-                    self.conf['acc'].accumulate(img_score)  # Global score
-
-                    IMG.fromarray(np.array(predicted_img, dtype=np.uint8)).save(
-                        os.path.join(self.log_dir, 'pred_' + img_obj.file_name.split('.')[0] + '.png'))
-                    IMG.fromarray(np.array(map_img, dtype=np.uint8)).save(
-                        os.path.join(self.log_dir, img_obj.file_name.split('.')[0] + '.png'))
-                else:
-                    img_score.add_tensor(predicted_img, gt)
-                    score_acc.accumulate(img_score)
-
-                prf1a = img_score.get_prfa()
-                print(img_obj.file_name, ' PRF1A', prf1a)
-                self.flush(logger, ','.join(str(x) for x in [img_obj.file_name] + prf1a))
+                img_score.add_tensor(predicted_img, gt)
+                score_acc.accumulate(img_score)
+
+            prf1a = img_score.get_prfa()
+            print(img_obj.file_name, ' PRF1A', prf1a, ' AUC', img_curves['ROC_AUC'][-1])
+            self.flush(logger, ','.join(str(x) for x in [img_obj.file_name] + prf1a))
+
+        self._eval_per_image(data_loader=data_loader, on_image_start=on_image_start, on_patch=on_patch,
+                             on_image_end=on_image_end)
+        if not gen_images:
+            # Ranks of a distributed run validate different images
+            score_acc.all_reduce()
+            curve_acc.all_reduce()
+        print('ROC AUC, PR AUC: ', curve_acc.get_auc(), ' Best F1, threshold: ', curve_acc.get_best_f1())
+        if gen_images and self.is_master:
+            self._save_curves(curve_acc, img_curves)
         self._save_if_better(score=score_acc.get_prfa()[2])
@@ -5,13 +5,11 @@
 """
 
 import os
-import random
-from random import shuffle
 
 import numpy as np
-import torch
 
 import utils.img_utils as imgutils
+from nbee.datacache import ArrayCache, PatchStore
 from nbee.datagen import Generator
 
 sep = os.sep
@@ -23,24 +21,56 @@ class PatchesGenerator(Generator):
         self.patch_shape = self.conf.get('Params').get('patch_shape')
         self.expand_by = self.conf.get('Params').get('expand_patch_by')
         self.patch_offset = self.conf.get('Params').get('patch_offset')
+        self.patches = None
+
+        # Content aware training patches: drop the ones that lie mostly outside the field of view, favor vessels
+        self.min_fov_coverage = self.conf.get('Params').get('min_fov_coverage', 0.0)
+        self.vessel_oversample = self.conf.get('Params').get('vessel_oversample', 0.0)
+        self.content_aware = self.mode == 'train' and (self.min_fov_coverage > 0 or self.vessel_oversample > 0)
+
         self._load_indices()
         self.gen_class_weights()
         print('Patches:', self.__len__())
 
-    def _load_indices(self):
-        for ID, img_file in enumerate(self.images):
+    def _get_image_obj(self, img_file=None):
+        return super(PatchesGenerator, self)._get_image_obj(img_file, channel=1)  # Just use green channel
 
-            img_obj = self._get_image_obj(img_file)
-            img_obj.working_arr = img_obj.working_arr[:, :, 1]  # Just use green channel
-            for chunk_ix in imgutils.get_chunk_indexes(img_obj.working_arr.shape, self.patch_shape,
-                                                       self.patch_offset):
-                self.indices.append([ID] + chunk_ix)
+    def _load_indices(self):
+        tables, foreground = [self.indices], [np.zeros(0)]
+        for ID, img_obj in self._load_image_objects():
+            chunk_indices = imgutils.get_chunk_indexes_array(img_obj.working_arr.shape, self.patch_shape,
+                                                             self.patch_offset)
+            if self.content_aware:
+                chunk_indices, fg = self._filter_by_content(img_obj, chunk_indices)
+                foreground.append(fg)
+            tables.append(self._index_table(ID, chunk_indices))
             self.image_objects[ID] = img_obj
+        self.indices = np.concatenate(tables)
+        if self.content_aware:
+            # Vessel rich patches are drawn more often: weight 1 + vessel_oversample * (fraction / mean fraction)
+            foreground = np.concatenate(foreground)
+            if foreground.size > 0:
+                self.patch_weights = 1.0 + self.vessel_oversample * foreground / max(foreground.mean(), 1e-8)
+            else:
+                # Mean of nothing is nan, and nan weights are rejected by the sampler. Plain uniform sampling instead.
+                print('### No patch passed min_fov_coverage. Patches are not weighted.')
+        if self.conf.get('Params').get('patch_store'):
+            self._load_patch_store()
         if self.shuffle_indices:
-            shuffle(self.indices)
+            self._shuffle_indices()
 
-    def __getitem__(self, index):
-        ID, row_from, row_to, col_from, col_to = self.indices[index]
+    def _filter_by_content(self, img_obj, chunk_indices):
+        """
+        :return: patches with fov coverage at least min_fov_coverage, and vessel fraction of each of those
+        """
+        coverage = np.ones(len(chunk_indices))
+        if img_obj.mask is not None:
+            coverage = imgutils.get_chunk_fractions(img_obj.mask, chunk_indices)
+        keep = coverage >= self.min_fov_coverage
+        return chunk_indices[keep], imgutils.get_chunk_fractions(img_obj.ground_truth, chunk_indices[keep])
+
+    def _get_patch(self, chunk_ix):
+        ID, row_from, row_to, col_from, col_to = [int(i) for i in chunk_ix[:5]]
         # img_tensor = self.image_objects[ID].working_arr[row_from:row_to, col_from:col_to]
         y = self.image_objects[ID].ground_truth[row_from:row_to, col_from:col_to]
 
@@ -48,37 +78,48 @@ class PatchesGenerator(Generator):
                                                            orig_patch_indices=[row_from, row_to, col_from, col_to],
                                                            expand_by=self.expand_by)
         img_tensor = np.pad(self.image_objects[ID].working_arr[p:q, r:s], pad, 'reflect')
+        return img_tensor, np.where(y == 255, 1, y)
+
+    def _load_patch_store(self):
+        """
+        Materialize all expanded input patches and label patches once into a PatchStore in the cache directory.
+        Each index gets the row of its patch in the store appended, so __getitem__ only slices the memory map.
+        """
+        if self.cache is None:
+            print('### Patch store needs a cache directory. Not used.')
+            return
 
-        if self.mode == 'train' and random.uniform(0, 1) <= 0.5:
-            img_tensor = np.flip(img_tensor, 0)
-            y = np.flip(y, 0)
+        key_parts = ['unet.PatchesGenerator', [self._get_cache_key(f, 1) for f in self.images],
+                     self.patch_shape, self.expand_by, self.patch_offset]
+        if self.content_aware:
+            key_parts.append(self.min_fov_coverage)
+        key = ArrayCache.key(*key_parts)
+        store = PatchStore(store_dir=self.cache.cache_dir, key=key)
+        if not store.exists():
+            input_shape = [self.patch_shape[0] + 2 * int(self.expand_by[0] / 2),
+                           self.patch_shape[1] + 2 * int(self.expand_by[1] / 2)]
+            store.write(index=self.indices.tolist(), input_shape=input_shape, label_shape=self.patch_shape,
+                        get_patch=self._get_patch)
+        inputs, labels, index = store.open()
+        self.patches = {'inputs': inputs, 'labels': labels}
+        self.indices = np.column_stack([np.array(index, dtype=np.int32).reshape(-1, 5),
+                                        np.arange(len(index), dtype=np.int32)])
 
-        if self.mode == 'train' and random.uniform(0, 1) <= 0.5:
-            img_tensor = np.flip(img_tensor, 1)
-            y = np.flip(y, 1)
+    def __getitem__(self, index):
+        ID, row_from, row_to, col_from, col_to = self.indices[index][:5].tolist()
+        if self.patches is not None:
+            row = int(self.indices[index][5])
+            img_tensor, y = self.patches['inputs'][row], self.patches['labels'][row]
+        else:
+            img_tensor, y = self._get_patch(self.indices[index])
 
-        img_tensor = img_tensor[..., None]
-        y[y == 255] = 1
+        # Without transforms the patch stays uint8 (1, H, W) and becomes float on the device, see UNetBee
         if self.transforms is not None:
-            img_tensor = self.transforms(img_tensor)
+            img_tensor = self.transforms(img_tensor[..., None])
+        else:
+            img_tensor = np.array(img_tensor[None, ...])
 
         return {'id': ID,
                 'inputs': img_tensor,
-                'labels': y.copy(),
+                'labels': np.array(y),
                 'clip_ix': np.array([row_from, row_to, col_from, col_to]), }
-
-    @classmethod
-    def get_loader_per_img(cls, images, conf, mode, transforms):
-        loaders = []
-        for file in images:
-            gen = cls(
-                conf=conf,
-                images=[file],
-                transforms=transforms,
-                shuffle_indices=False,
-                mode=mode
-            )
-            loader = torch.utils.data.DataLoader(gen, batch_size=min(1, gen.__len__()),
-                                                 shuffle=False, num_workers=3, sampler=None)
-            loaders.append(loader)
-        return loaders
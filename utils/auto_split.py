@@ -29,6 +29,19 @@ def load_split_json(json_file):
         print(json_file + ' FILE NOT LOADED !!!')
 
 
+def get_split_images(splits_dir=None):
+    """
+    :param splits_dir: Directory of split json files
+    :return: Sorted list of all images in any set of any split
+    """
+    images = set()
+    for split in os.listdir(splits_dir):
+        splits = load_split_json(os.path.join(splits_dir, split))
+        for _, files in splits.items():
+            images.update(files)
+    return sorted(images)
+
+
 def create_splits(files, sep1=('', 0), sep2=('', 0), json_file=None):
     """
     :param files: List of files to split into three disjoint sets of any size
@@ -22,6 +22,58 @@ def get_class_weights(y):
     return {cls: round(majority / count) for cls, count in counter.items()}
 
 
+def get_label_histogram(y, bins=256):
+    """
+    :param y: labels of unsigned integer type(eg. uint8 ground truth)
+    :return: count of each label value, of length at least bins
+    """
+    return np.bincount(np.asarray(y).ravel(), minlength=bins)
+
+
+def get_class_weights_from_histogram(hist):
+    """
+    :param hist: label histogram, see get_label_histogram
+    :return: Same as get_class_weights of the labels the histogram was made from
+    """
+    present = np.nonzero(hist)[0]
+    majority = hist[present].max()
+    return {cls: round(majority / hist[cls]) for cls in present.tolist()}
+
+
+class ClassWeightStats:
+    """
+    Class weights of a set of images, as the mean of get_class_weights of each image.
+    Images are added/removed one by one with their label histograms, so changing the set never needs a rescan.
+    """
+
+    def __init__(self, classes=(0, 255)):
+        self.classes = classes
+        self.image_weights = {}
+        self.total = np.zeros(len(classes))
+
+    def add(self, key=None, hist=None):
+        if key in self.image_weights:
+            self.remove(key)
+        weights = get_class_weights_from_histogram(hist)
+        self.image_weights[key] = np.array([weights[c] for c in self.classes], dtype=np.float64)
+        self.total += self.image_weights[key]
+
+    def remove(self, key=None):
+        self.total -= self.image_weights.pop(key)
+
+    def keys(self):
+        return list(self.image_weights.keys())
+
+    def __contains__(self, key):
+        return key in self.image_weights
+
+    def get_class_weights(self):
+        """
+        :return: List of weights in the order of classes
+        """
+        return [float(w) / len(self.image_weights) for w in self.total]
+
+
 def get_4_flips(img_obj=None):
     flipped = [img_obj]
     copy0 = img_obj.__copy__()
@@ -0,0 +1,192 @@
+"""
+A whole dataset(images, masks, ground truths, splits) in one binary file with random access per image and per tile
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import hashlib
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+from utils.img_utils import Image
+
+"""
+#####################################################################################
+File layout:
+    MAGIC | array, array, ... | header json | header offset(uint64) | header length(uint64) | MAGIC
+Each array is stored tile by tile, shape (tile rows, tile cols, tile_shape[0], tile_shape[1], channels...),
+zero padded at the right/bottom border, so one tile is one contiguous read.
+Header has, for each image, the entries 'image', 'mask' and 'truth' with offset, dtype, shape, tile_shape,
+original file name and sha1 of the original file. Split jsons are kept as they are under 'splits'.
+#####################################################################################
+"""
+
+MAGIC = b'ATUREPK1'
+_ALIGN = 64
+_TRAILER = struct.Struct('<QQ')
+
+
+def _file_digest(file, block_size=1 << 20):
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _tiled(arr, tile_shape):
+    th, tw = tile_shape
+    nty, ntx = -(-arr.shape[0] // th), -(-arr.shape[1] // tw)
+    padded = np.zeros((nty * th, ntx * tw) + arr.shape[2:], dtype=arr.dtype)
+    padded[:arr.shape[0], :arr.shape[1]] = arr
+    padded = padded.reshape((nty, th, ntx, tw) + arr.shape[2:])
+    return np.ascontiguousarray(padded.swapaxes(1, 2))
+
+
+def pack_dataset(conf=None, pack_file=None, images=None, tile_shape=(256, 256)):
+    """
+    One shot conversion of a dataset directory into a DataPack file. Images, masks and ground truths are decoded
+    exactly as Image.load_file, load_mask and load_ground_truth do.
+    :param conf: JSON file. see runs.py. Uses Dirs image, mask, truth, splits_json and Funcs mask_getter, truth_getter
+    :param pack_file: File to write
+    :param images: Images to pack. Default is all in Dirs['image']
+    :param tile_shape: Shape(rows, cols) of the tiles
+    """
+    dirs, funcs = conf.get('Dirs'), conf.get('Funcs')
+    if images is None:
+        images = sorted(os.listdir(dirs.get('image')))
+
+    header = {'tile_shape': list(tile_shape), 'images': {}, 'splits': {}}
+    tmp = pack_file + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(MAGIC)
+
+        def _write(arr, file):
+            if arr is None:
+                return None
+            f.write(b'\0' * (-f.tell() % _ALIGN))
+            entry = {'offset': f.tell(), 'dtype': arr.dtype.str, 'shape': list(arr.shape),
+                     'file': os.path.basename(file), 'digest': _file_digest(file)}
+            f.write(_tiled(arr, tile_shape).tobytes())
+            return entry
+
+        for i, img_file in enumerate(images, 1):
+            img_obj = Image()
+            img_obj.load_file(data_dir=dirs.get('image'), file_name=img_file)
+            entries = {'image': _write(img_obj.image_arr, os.path.join(dirs.get('image'), img_file))}
+            if funcs.get('mask_getter') is not None:
+                img_obj.load_mask(mask_dir=dirs.get('mask'), fget_mask=funcs.get('mask_getter'))
+                entries['mask'] = _write(img_obj.mask, os.path.join(dirs.get('mask'), funcs['mask_getter'](img_file)))
+            if funcs.get('truth_getter') is not None:
+                img_obj.load_ground_truth(gt_dir=dirs.get('truth'), fget_ground_truth=funcs.get('truth_getter'))
+                entries['truth'] = _write(img_obj.ground_truth,
+                                          os.path.join(dirs.get('truth'), funcs['truth_getter'](img_file)))
+            header['images'][img_file] = entries
+            print('Packed: ', i, '/', len(images), end='\r')
+
+        if dirs.get('splits_json') is not None and os.path.isdir(dirs.get('splits_json')):
+            for split in sorted(os.listdir(dirs.get('splits_json'))):
+                with open(os.path.join(dirs.get('splits_json'), split)) as s:
+                    header['splits'][split] = json.load(s)
+
+        header_bytes = json.dumps(header).encode('utf-8')
+        header_offset = f.tell()
+        f.write(header_bytes)
+        f.write(_TRAILER.pack(header_offset, len(header_bytes)))
+        f.write(MAGIC)
+    os.replace(tmp, pack_file)
+    print('### Packed ' + str(len(images)) + ' images into ' + pack_file)
+
+
+class DataPack:
+    """
+    Read access to a file written by pack_dataset(). The file is memory mapped once per process,
+    so only the pages of the images/tiles that are actually read are loaded.
+    """
+
+    def __init__(self, pack_file=None):
+        self.pack_file = pack_file
+        with open(self.pack_file, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError('### Not a data pack: ' + self.pack_file)
+            f.seek(-(_TRAILER.size + len(MAGIC)), os.SEEK_END)
+            header_offset, header_len = _TRAILER.unpack(f.read(_TRAILER.size))
+            f.seek(header_offset)
+            self.header = json.loads(f.read(header_len).decode('utf-8'))
+        self.tile_shape = tuple(self.header['tile_shape'])
+        self.images = list(self.header['images'].keys())
+        self.splits = self.header['splits']
+        self._buffer = None
+
+    def __getstate__(self):
+        # DataLoader workers map the file on their own instead of receiving its content
+        state = self.__dict__.copy()
+        state['_buffer'] = None
+        return state
+
+    def _tiles(self, entry):
+        if self._buffer is None:
+            self._buffer = np.memmap(self.pack_file, dtype=np.uint8, mode='r')
+        shape = entry['shape']
+        th, tw = self.tile_shape
+        tiles_shape = (-(-shape[0] // th), -(-shape[1] // tw), th, tw) + tuple(shape[2:])
+        dtype = np.dtype(entry['dtype'])
+        nbytes = int(np.prod(tiles_shape)) * dtype.itemsize
+        return self._buffer[entry['offset']:entry['offset'] + nbytes].view(dtype).reshape(tiles_shape)
+
+    def get_entry(self, file_name=None, key='image'):
+        """
+        :param file_name: Image file name as it was in the image directory
+        :param key: 'image', 'mask' or 'truth'
+        :return: Header entry, None if not packed
+        """
+        return self.header['images'][file_name].get(key)
+
+    def get_array(self, file_name=None, key='image'):
+        """
+        :return: Writable copy of the whole array, None if not packed
+        """
+        entry = self.get_entry(file_name, key)
+        if entry is None:
+            return None
+        tiles = self._tiles(entry)
+        shape = entry['shape']
+        full = tiles.swapaxes(1, 2).reshape((tiles.shape[0] * tiles.shape[2], tiles.shape[1] * tiles.shape[3]) +
+                                            tuple(shape[2:]))
+        return np.array(full[:shape[0], :shape[1]])
+
+    def get_tile(self, file_name=None, key='image', tile_row=0, tile_col=0):
+        """
+        :return: Copy of one tile(cut at the border of the array), reading only that tile from the file
+        """
+        entry = self.get_entry(file_name, key)
+        if entry is None:
+            return None
+        th, tw = self.tile_shape
+        rows = min(th, entry['shape'][0] - tile_row * th)
+        cols = min(tw, entry['shape'][1] - tile_col * tw)
+        return np.array(self._tiles(entry)[tile_row, tile_col, :rows, :cols])
+
+    def get_image_obj(self, file_name=None):
+        """
+        :return: Image object with image_arr, mask and ground_truth as Image.load_* would give
+        """
+        img_obj = Image()
+        img_obj.data_dir = self.pack_file
+        img_obj.file_name = file_name
+        img_obj.image_arr = self.get_array(file_name, 'image')
+        img_obj.mask = self.get_array(file_name, 'mask')
+        img_obj.ground_truth = self.get_array(file_name, 'truth')
+        return img_obj
+
+
+if __name__ == "__main__":
+    import testarch.unet.runs as runs
+
+    # Usage(from the repo root): python -m utils.datapack DRIVE data/DRIVE/DRIVE.pack
+    pack_dataset(conf=getattr(runs, sys.argv[1]), pack_file=sys.argv[2])
@@ -6,7 +6,6 @@ Very useful utilities for working with images
 """
 
 import copy
-import math
 import os
 
 import cv2
@@ -95,26 +94,31 @@ def get_rgb_scores(arr_2d=None, truth=None):
     Returns a rgb image of pixelwise separation between ground truth and arr_2d
     (predicted image) with different color codes
     Easy when needed to inspect segmentation result against ground truth.
+    White: true positive, green: false positive, red: false negative. Everything else is black.
     :param arr_2d:
     :param truth:
     :return:
     """
-    arr_rgb = np.zeros([arr_2d.shape[0], arr_2d.shape[1], 3], dtype=np.uint8)
-    for i in range(0, arr_2d.shape[0]):
-        for j in range(0, arr_2d.shape[1]):
-            if arr_2d[i, j] == 255 and truth[i, j] == 255:
-                arr_rgb[i, j, :] = 255
-            if arr_2d[i, j] == 255 and truth[i, j] == 0:
-                arr_rgb[i, j, 0] = 0
-                arr_rgb[i, j, 1] = 255
-                arr_rgb[i, j, 2] = 0
-            if arr_2d[i, j] == 0 and truth[i, j] == 255:
-                arr_rgb[i, j, 0] = 255
-                arr_rgb[i, j, 1] = 0
-                arr_rgb[i, j, 2] = 0
+    arr_2d, truth = np.asarray(arr_2d), np.asarray(truth)
+    arr_rgb = np.zeros(np.broadcast(arr_2d, truth).shape + (3,), dtype=np.uint8)
+    arr_rgb[(arr_2d == 255) & (truth == 255)] = 255
+    arr_rgb[(arr_2d == 255) & (truth == 0)] = [0, 255, 0]
+    arr_rgb[(arr_2d == 0) & (truth == 255)] = [255, 0, 0]
     return arr_rgb
 
 
+def get_rgb_scores_batch(arrs=None, truths=None):
+    """
+    get_rgb_scores of a whole stack of predictions at once, eg. all test images of a size.
+    :param arrs: (N, H, W) array or list of N predicted images of the same shape
+    :param truths: (N, H, W) array or list of ground truths, or one (H, W) ground truth for all
+    :return: (N, H, W, 3) uint8 array
+    """
+    arrs = np.stack(arrs) if isinstance(arrs, (list, tuple)) else arrs
+    truths = np.stack(truths) if isinstance(truths, (list, tuple)) else truths
+    return get_rgb_scores(arrs, truths)
+
+
 def get_praf1(arr_2d=None, truth=None):
     """
     Returns precision, recall, f1 and accuracy score between two binary arrays upto five precision.
@@ -259,6 +263,67 @@ def get_chunk_indices_by_index(img_shape=(0, 0), chunk_shape=(0, 0), indices=Non
         yield [int(p), int(q), int(r), int(s)]
 
 
+def _chunk_starts(size, chunk, offset):
+    # Starts as get_chunk_indexes walks them: the first one that overflows is moved back to end at size, rest dropped
+    starts = np.arange(0, size, offset)
+    over = np.nonzero(starts + chunk > size)[0]
+    if len(over) > 0:
+        starts = starts[:over[0] + 1]
+        starts[-1] = size - chunk
+    return starts
+
+
+def get_chunk_indexes_array(img_shape=(0, 0), chunk_shape=(0, 0), offset_row_col=None):
+    """
+    Same patches, in the same order, as get_chunk_indexes but all at once.
+    :param img_shape: Shape of the original image
+    :param chunk_shape: Shape of desired patch
+    :param offset_row_col: Offset for each patch on both x, y directions
+    :return: (N, 4) int32 array of [row_from, row_to, col_from, col_to]
+    """
+    rows = _chunk_starts(img_shape[0], chunk_shape[0], offset_row_col[0])
+    cols = _chunk_starts(img_shape[1], chunk_shape[1], offset_row_col[1])
+    chunks = np.empty((len(rows) * len(cols), 4), dtype=np.int32)
+    chunks[:, 0] = np.repeat(rows, len(cols))
+    chunks[:, 1] = chunks[:, 0] + chunk_shape[0]
+    chunks[:, 2] = np.tile(cols, len(rows))
+    chunks[:, 3] = chunks[:, 2] + chunk_shape[1]
+    return chunks
+
+
+def get_chunk_indices_by_index_array(img_shape=(0, 0), chunk_shape=(0, 0), indices=None):
+    """
+    Same patches, in the same order, as get_chunk_indices_by_index but all at once.
+    :param img_shape: Original image shape
+    :param chunk_shape: Desired patch shape
+    :param indices: (K, 2) array of pixel locations(eg. np.argwhere) around which the patch corners will be generated
+    :return: (N, 4) int32 array of [row_from, row_to, col_from, col_to] of the patches that lie within the image
+    """
+    x, y = chunk_shape
+    row_from = x // 2 - 1 if x % 2 == 0 else x // 2
+    col_from = y // 2 - 1 if y % 2 == 0 else y // 2
+    row_to, col_to = x // 2 + 1, y // 2 + 1
+
+    indices = np.asarray(indices, dtype=np.int64).reshape(-1, 2)
+    chunks = np.stack([indices[:, 0] - row_from, indices[:, 0] + row_to,
+                       indices[:, 1] - col_from, indices[:, 1] + col_to], axis=1)
+    inside = (chunks[:, 0] >= 0) & (chunks[:, 2] >= 0) & (chunks[:, 1] <= img_shape[0]) & (chunks[:, 3] <= img_shape[1])
+    return chunks[inside].astype(np.int32)
+
+
+def get_chunk_fractions(arr_2d=None, chunk_indices=None):
+    """
+    Fraction of nonzero pixels within each patch, all patches at once from one summed area table.
+    :param arr_2d: 2D array, eg. fov mask or ground truth
+    :param chunk_indices: (N, 4) array of [row_from, row_to, col_from, col_to]
+    :return: (N,) float array
+    """
+    sat = np.zeros((arr_2d.shape[0] + 1, arr_2d.shape[1] + 1), dtype=np.int64)
+    sat[1:, 1:] = (arr_2d > 0).cumsum(0).cumsum(1)
+    p, q, r, s = np.asarray(chunk_indices, dtype=np.int64).reshape(-1, 4).T
+    return (sat[q, s] - sat[p, s] - sat[q, r] + sat[p, r]) / ((q - p) * (s - r))
+
+
 def merge_patches(patches=None, image_size=(0, 0), patch_size=(0, 0), offset_row_col=None):
     """
     Merge different pieces of image to form a full image. Overlapped regions are averaged.
@@ -268,19 +333,48 @@ def merge_patches(patches=None, image_size=(0, 0), patch_size=(0, 0), offset_row
     :param offset_row_col: Offset used to chunk the patches.
     :return:
     """
-    padded_sum = np.zeros([image_size[0], image_size[1]])
-    non_zero_count = np.zeros_like(padded_sum)
-    for i, chunk_ix in enumerate(get_chunk_indexes(image_size, patch_size, offset_row_col)):
-        row_from, row_to, col_from, col_to = chunk_ix
+    merger = PatchMerger(image_size=image_size)
+    merger.add_batch(patches, get_chunk_indexes_array(image_size, patch_size, offset_row_col))
+    return merger.get_image(dtype=np.uint8)
 
-        patch = np.array(patches[i, :, :]).squeeze()
 
-        padded = np.pad(patch, [(row_from, image_size[0] - row_to), (col_from, image_size[1] - col_to)],
-                        'constant')
-        padded_sum = padded + padded_sum
-        non_zero_count = non_zero_count + np.array(padded > 0).astype(int)
-    non_zero_count[non_zero_count == 0] = 1
-    return np.array(padded_sum / non_zero_count, dtype=np.uint8)
+class PatchMerger:
+    """
+    Reassembles an image from patches added at their slices into one sum and one count buffer, so patches can be
+    fed as they come(eg. batch after batch off the model) at O(patch) each. Where patches overlap, nonzero values
+    are averaged as merge_patches does.
+    """
+
+    def __init__(self, image_size=(0, 0)):
+        self.sum = np.zeros(tuple(image_size[:2]), dtype=np.float64)
+        self.count = np.zeros(tuple(image_size[:2]), dtype=np.int32)
+
+    def add(self, patch=None, chunk_ix=None):
+        """
+        :param patch: 2D patch(extra axes of size 1 are squeezed)
+        :param chunk_ix: [row_from, row_to, col_from, col_to] of the patch
+        """
+        row_from, row_to, col_from, col_to = [int(i) for i in chunk_ix]
+        patch = np.asarray(patch).squeeze()
+        self.sum[row_from:row_to, col_from:col_to] += patch
+        self.count[row_from:row_to, col_from:col_to] += patch > 0
+        return self
+
+    def add_batch(self, patches=None, chunk_indices=None):
+        """
+        :param patches: (N, ...) patches
+        :param chunk_indices: (N, 4) array of their corners
+        """
+        for i, chunk_ix in enumerate(chunk_indices):
+            self.add(patches[i], chunk_ix)
+        return self
+
+    def get_image(self, dtype=np.uint8):
+        """
+        :param dtype: np.uint8 as merge_patches gives, or a float type to keep the averages
+        :return: Merged image
+        """
+        return np.array(self.sum / np.maximum(self.count, 1), dtype=dtype)
 
 
 def expand_and_mirror_patch(full_img_shape=None, orig_patch_indices=None, expand_by=None):
@@ -315,21 +409,30 @@ def expand_and_mirror_patch(full_img_shape=None, orig_patch_indices=None, expand
 def remove_connected_comp(segmented_img, connected_comp_diam_limit=20):
     """
     Remove connected components of a binary image that are less than smaller than specified diameter.
+    Diameter of a component is the distance between its first and last pixel in row major order.
+    All components are measured in one pass and removed with one lookup of their labels.
     :param segmented_img: Binary image.
     :param connected_comp_diam_limit: Diameter limit
     :return:
     """
     img = segmented_img.copy()
-    structure = np.ones((3, 3), dtype=np.int)
+    structure = np.ones((3, 3), dtype=int)
     labeled, n_components = label(img, structure)
-    for i in range(n_components):
-        ixy = np.array(list(zip(*np.where(labeled == i))))
-        x1, y1 = ixy[0]
-        x2, y2 = ixy[-1]
-        dst = math.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2)
-        if dst < connected_comp_diam_limit:
-            for u, v in ixy:
-                img[u, v] = 0
+    if n_components == 0:
+        return img
+
+    # Positions come in row major order, so the first/last index of each label is its first/last pixel
+    pos = np.flatnonzero(labeled)
+    labels = labeled.ravel()[pos]
+    _, first = np.unique(labels, return_index=True)
+    _, last = np.unique(labels[::-1], return_index=True)
+    first, last = pos[first], pos[len(pos) - 1 - last]
+
+    x1, y1 = np.divmod(first, labeled.shape[1])
+    x2, y2 = np.divmod(last, labeled.shape[1])
+    small = np.zeros(n_components + 1, dtype=bool)
+    small[1:] = np.sqrt((x2 - x1) ** 2 + (y2 - y1) ** 2) < connected_comp_diam_limit
+    img[small[labeled]] = 0
     return img
 
 
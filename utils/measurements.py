@@ -11,8 +11,6 @@ import numpy as np
 import torch
 from sklearn.metrics import confusion_matrix
 
-import imgcommons.utils as imgutils
-
 
 def plot_confusion_matrix(y_pred=None, y_true=None, classes=None, normalize=False, cmap=plt.cm.Greens):
     """
@@ -46,8 +44,14 @@ def plot_confusion_matrix(y_pred=None, y_true=None, classes=None, normalize=Fals
 
 
 class ScoreAccumulator:
+    """
+    Counts of true/false positives/negatives. Counts added by add_tensor stay on the device of the tensors, without
+    any host sync, until they are needed(get_prfa, accumulate, all_reduce or an explicit sync()).
+    """
+
     def __init__(self):
         self.tn, self.fp, self.fn, self.tp = [0] * 4
+        self._pending = None
 
     def add(self, tn=0, fp=0, fn=0, tp=0):
         self.tp += tp
@@ -56,20 +60,31 @@ class ScoreAccumulator:
         self.fn += fn
         return self
 
-    def add_tensor(self, y_pred_tensor, y_true_tensor):
-
-        y_true = y_true_tensor.clone().int().view(1, -1).squeeze()
-        y_pred = y_pred_tensor.clone().int().view(1, -1).squeeze()
+    @staticmethod
+    def get_tensor_counts(y_pred_tensor, y_true_tensor):
+        """
+        :return: Tensor [tn, fp, fn, tp] on the device of the inputs, counted in one scatter_add(no host sync)
+        """
+        y_true = y_true_tensor.reshape(-1).long()
+        y_pred = y_pred_tensor.reshape(-1).long()
+        y_cases = y_true.masked_fill(y_true == 255, 1) * 2 + y_pred.masked_fill(y_pred == 255, 1)
+        valid = (y_cases >= 0) & (y_cases <= 3)
+        counts = torch.zeros(4, dtype=torch.int64, device=y_cases.device)
+        return counts.scatter_add_(0, y_cases.clamp(0, 3), valid.long())
 
-        y_true[y_true == 255] = 1
-        y_pred[y_pred == 255] = 1
+    def add_tensor(self, y_pred_tensor, y_true_tensor):
+        counts = ScoreAccumulator.get_tensor_counts(y_pred_tensor, y_true_tensor)
+        self._pending = counts if self._pending is None else self._pending + counts
+        return self
 
-        y_true = y_true * 2
-        y_cases = y_true + y_pred
-        self.tp += torch.sum(y_cases == 3).item()
-        self.fp += torch.sum(y_cases == 1).item()
-        self.tn += torch.sum(y_cases == 0).item()
-        self.fn += torch.sum(y_cases == 2).item()
+    def sync(self):
+        """
+        Move the counts pending on the device into tn, fp, fn, tp.
+        """
+        if self._pending is not None:
+            tn, fp, fn, tp = self._pending.tolist()
+            self._pending = None
+            self.add(tn=tn, fp=fp, fn=fn, tp=tp)
         return self
 
     def add_array(self, arr_2d=None, truth=None):
@@ -85,6 +100,8 @@ class ScoreAccumulator:
         return self
 
     def accumulate(self, other):
+        if other._pending is not None:
+            self._pending = other._pending if self._pending is None else self._pending + other._pending
         self.tp += other.tp
         self.fp += other.fp
         self.tn += other.tn
@@ -93,9 +110,22 @@ class ScoreAccumulator:
 
     def reset(self):
         self.tn, self.fp, self.fn, self.tp = [0] * 4
+        self._pending = None
+        return self
+
+    def all_reduce(self):
+        """
+        Sum up the counts of all ranks of a distributed(torch.distributed) run, nothing otherwise.
+        """
+        self.sync()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            counts = torch.tensor([self.tn, self.fp, self.fn, self.tp], dtype=torch.int64)
+            torch.distributed.all_reduce(counts)
+            self.tn, self.fp, self.fn, self.tp = counts.tolist()
         return self
 
     def get_prfa(self, beta=1):
+        self.sync()
         try:
             p = self.tp / (self.tp + self.fp)
         except ZeroDivisionError:
@@ -134,20 +164,187 @@ class AverageMeter(object):
         self.avg = self.sum / self.count
 
 
-def get_best_thr(img, y, for_best='F1'):
-    best_score = {for_best: 0.0}
-    best_thr = 0.0
+def get_threshold_histograms(img=None, y=None):
+    """
+    Histograms of a probability image(0-255) over the pixels that are vessel and background in the ground truth.
+    A pixel of value v is predicted vessel at threshold thr if v > thr, that is if ceil(v) > thr,
+    so pixels are binned by ceil(v) clipped to [0, 256].
+    :param img: Probability image
+    :param y: Ground truth(255 or 1 vessel, 0 background, anything else is ignored)
+    :return: histogram of vessel pixels, histogram of background pixels, both of length 257
+    """
+    img, y = np.asarray(img), np.asarray(y)
+    if not np.issubdtype(img.dtype, np.integer):
+        img = np.ceil(img)
+    bins = np.clip(img, 0, 256).astype(np.intp)
+    hist_pos = np.bincount(bins[(y == 255) | (y == 1)], minlength=257)
+    hist_neg = np.bincount(bins[y == 0], minlength=257)
+    return hist_pos, hist_neg
 
+
+def get_counts_by_thr(hist_pos=None, hist_neg=None, thresholds=np.arange(1, 256)):
+    """
+    tp, fp, fn, tn when the pixels binned in hist_pos/hist_neg(see get_threshold_histograms) are predicted vessel
+    if their bin is > thr, for all thresholds at once from cumulative sums.
+    :param hist_pos: Vessel histogram
+    :param hist_neg: Background histogram
+    :param thresholds: Integer thresholds in [0, len(hist) - 1]
+    :return: tp, fp, fn, tn arrays, one value per threshold
+    """
+    tp = hist_pos.sum() - np.cumsum(hist_pos)[thresholds]
+    fp = hist_neg.sum() - np.cumsum(hist_neg)[thresholds]
+    return tp, fp, hist_pos.sum() - tp, hist_neg.sum() - fp
+
+
+def get_scores_by_thr(hist_pos=None, hist_neg=None, thresholds=np.arange(1, 256)):
+    """
+    Precision, Recall, Accuracy and F1(as utils.img_utils.get_praf1, before rounding) at all thresholds at once.
+    :return: dict of arrays, one value per threshold
+    """
+    tp, fp, fn, tn = get_counts_by_thr(hist_pos, hist_neg, thresholds)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(tp + fp > 0, tp / (tp + fp), 0)
+        r = np.where(tp + fn > 0, tp / (tp + fn), 0)
+        a = np.where(tp + fp + fn + tn > 0, (tp + tn) / (tp + fp + fn + tn), 0)
+        f1 = np.where(p + r > 0, 2 * p * r / (p + r), 0)
+    return {'Precision': p, 'Recall': r, 'Accuracy': a, 'F1': f1}
+
+
+def _best_thr_from_histograms(hist_pos, hist_neg, for_best='F1', thresholds=np.arange(1, 256)):
+    scores = get_scores_by_thr(hist_pos, hist_neg, thresholds)
+    # Same choice as comparing rounded get_praf1 scores threshold after threshold: first one that is best and > 0
+    target = np.array([round(v, 5) for v in scores[for_best].tolist()])
+    if target.max() <= 0:
+        return {for_best: 0.0}, 0.0
+    i = int(np.argmax(target))
+    best_score = {k: round(float(v[i]), 5) for k, v in scores.items()}
+    return best_score, float(thresholds[i])
+
+
+def get_best_thr(img, y, for_best='F1'):
+    """
+    Threshold in 1...255 that maximizes for_best when a probability image is binarized as img > thr.
+    :return: best_score(dict of Precision, Recall, Accuracy, F1), thr
+    """
     if np.sum(y) == 0:
-        best_score[for_best] = 1
-        return best_score, 255.0
-
-    for thr in np.linspace(1, 255, 255):
-        i_best = img.copy()
-        i_best[i_best > thr] = 255
-        i_best[i_best <= thr] = 0
-        current_score = imgutils.get_praf1(i_best, y)
-        if current_score[for_best] > best_score[for_best]:
-            best_score = current_score
-            best_thr = thr
-    return best_score, best_thr
+        return {for_best: 1}, 255.0
+    return _best_thr_from_histograms(*get_threshold_histograms(img, y), for_best=for_best)
+
+
+def get_best_thrs(imgs=None, ys=None, for_best='F1'):
+    """
+    get_best_thr of many images at once, from one histogram pass over each image.
+    :param imgs: List of probability images
+    :param ys: List of ground truths
+    :param for_best: Score to maximize
+    :return: list of (best_score, thr) of each image, and (best_score, thr) of all images taken together
+    """
+    per_image = []
+    total_pos, total_neg, total_y = np.zeros(257, dtype=np.int64), np.zeros(257, dtype=np.int64), 0
+    for img, y in zip(imgs, ys):
+        hist_pos, hist_neg = get_threshold_histograms(img, y)
+        y_sum = np.sum(y)
+        per_image.append(({for_best: 1}, 255.0) if y_sum == 0 else
+                         _best_thr_from_histograms(hist_pos, hist_neg, for_best=for_best))
+        total_pos, total_neg, total_y = total_pos + hist_pos, total_neg + hist_neg, total_y + y_sum
+
+    if total_y == 0:
+        return per_image, ({for_best: 1}, 255.0)
+    return per_image, _best_thr_from_histograms(total_pos, total_neg, for_best=for_best)
+
+
+class CurveAccumulator:
+    """
+    Streaming PR/ROC curves of probability maps. Probabilities are binned(by ceil(p * num_bins), as
+    get_threshold_histograms does for 0-255 maps) into num_bins + 1 buckets per ground truth class, on the device of
+    the tensors and without host sync. Memory is those two histograms, whatever the number of pixels/images added.
+    A pixel is predicted vessel at threshold k / num_bins if its bucket is > k.
+    """
+
+    def __init__(self, num_bins=255):
+        self.num_bins = num_bins
+        self.hist_pos = np.zeros(num_bins + 1, dtype=np.int64)
+        self.hist_neg = np.zeros(num_bins + 1, dtype=np.int64)
+        self._pending = None
+
+    def add_tensor(self, prob_tensor, y_true_tensor):
+        """
+        :param prob_tensor: Vessel probabilities in [0, 1]
+        :param y_true_tensor: Ground truth(255 or 1 vessel, 0 background, anything else is ignored)
+        """
+        y_true = y_true_tensor.reshape(-1)
+        prob = prob_tensor.reshape(-1)
+        # Tolerance, in the precision of the map, keeps values that are k / num_bins(eg. uint8 / 255) in bucket k
+        tol = torch.finfo(prob.dtype).eps * self.num_bins if prob.is_floating_point() else 0.0
+        bins = torch.ceil(prob.double() * self.num_bins - tol).clamp(0, self.num_bins).long()
+        is_pos, is_neg = (y_true == 255) | (y_true == 1), y_true == 0
+        # Background buckets first, vessel buckets after them
+        counts = torch.zeros(2 * (self.num_bins + 1), dtype=torch.int64, device=bins.device)
+        counts.scatter_add_(0, bins + is_pos.long() * (self.num_bins + 1), (is_pos | is_neg).long())
+        self._pending = counts if self._pending is None else self._pending + counts
+        return self
+
+    def add_array(self, prob_arr=None, truth=None):
+        return self.add_tensor(torch.from_numpy(np.asarray(prob_arr)), torch.from_numpy(np.asarray(truth)))
+
+    def sync(self):
+        if self._pending is not None:
+            counts = self._pending.cpu().numpy()
+            self._pending = None
+            self.hist_neg += counts[:self.num_bins + 1]
+            self.hist_pos += counts[self.num_bins + 1:]
+        return self
+
+    def accumulate(self, other):
+        self.sync()
+        other.sync()
+        self.hist_pos += other.hist_pos
+        self.hist_neg += other.hist_neg
+        return self
+
+    def all_reduce(self):
+        """
+        Sum up the histograms of all ranks of a distributed(torch.distributed) run, nothing otherwise.
+        """
+        self.sync()
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            hists = torch.from_numpy(np.stack([self.hist_pos, self.hist_neg]))
+            torch.distributed.all_reduce(hists)
+            self.hist_pos, self.hist_neg = hists.numpy()
+        return self
+
+    def get_curves(self):
+        """
+        :return: dict of thresholds(probability), precision, recall(tpr) and fpr, from the lowest threshold
+        """
+        self.sync()
+        thresholds = np.arange(self.num_bins + 1)
+        tp, fp, fn, tn = get_counts_by_thr(self.hist_pos, self.hist_neg, thresholds)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(tp + fp > 0, tp / (tp + fp), 1.0)
+            recall = np.where(tp + fn > 0, tp / (tp + fn), 0.0)
+            fpr = np.where(fp + tn > 0, fp / (fp + tn), 0.0)
+        return {'thresholds': thresholds / self.num_bins, 'precision': precision, 'recall': recall, 'fpr': fpr}
+
+    def get_auc(self):
+        """
+        :return: Area under ROC curve, area under PR curve(average precision)
+        """
+        c = self.get_curves()
+        # Threshold below every bucket predicts all pixels vessel: the (1, 1) end of ROC
+        fpr, tpr = np.concatenate([[1.0], c['fpr']]), np.concatenate([[1.0], c['recall']])
+        roc_auc = float(np.sum((fpr[:-1] - fpr[1:]) * (tpr[:-1] + tpr[1:]) / 2))
+        # Each step of recall is weighted by the precision of the lower threshold, which reaches it
+        precision = np.concatenate([[self.hist_pos.sum() / max(self.hist_pos.sum() + self.hist_neg.sum(), 1)],
+                                    c['precision']])
+        pr_auc = float(np.sum((tpr[:-1] - tpr[1:]) * precision[:-1]))
+        return round(roc_auc, 5), round(pr_auc, 5)
+
+    def get_best_f1(self):
+        """
+        :return: best_score(dict of Precision, Recall, Accuracy, F1), probability threshold giving it
+        """
+        self.sync()
+        best_score, thr = _best_thr_from_histograms(self.hist_pos, self.hist_neg, for_best='F1',
+                                                    thresholds=np.arange(self.num_bins + 1))
+        return best_score, thr / self.num_bins
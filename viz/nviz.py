@@ -1,17 +1,41 @@
+import os
+
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+from nbee.metricstore import is_store, read_metrics
+
 plt.switch_backend('agg')
 
 
-def plot(file=None, y=None, query=None, title='', save=False, x_tick_skip=None):
+def _get_df(file=None, df=None, query=None, columns=None, max_points=None):
+    # Rows already parsed(eg. by viz.plotservice) are used as they are, file is then only for the name of the figure.
+    # A metrics store(see nbee.metricstore) is read at the finest resolution that has at most max_points rows, and
+    # only the columns drawn(all of them for a query).
+    if df is None and os.path.isdir(file) and is_store(file):
+        columns = None if query else list(dict.fromkeys(c for c in columns if c is not None))
+        df = read_metrics(file, columns=columns, max_rows=max_points)
+    elif df is None:
+        df = pd.read_csv(file)
+    return df.query(query) if query else df
+
+
+def _downsample(df, max_points=None):
+    # Every n-th row, keeping the index(x axis), so that a figure never draws more than max_points
+    if max_points is None or df.shape[0] <= max_points:
+        return df
+    return df.iloc[::-(-df.shape[0] // max_points)]
+
+
+def plot(file=None, y=None, query=None, title='', save=False, x_tick_skip=None, df=None, max_points=None):
     try:
-        df = pd.read_csv(file).query(query) if query else pd.read_csv(file)
-        df_sample = df.copy()
+        df = _get_df(file, df, query, columns=[y], max_points=max_points)
+        df_sample = df[[y]].copy()
         w = max(int(df.shape[0] / 1000), 5) if df.shape[0] >= 100 else 1
 
         df_sample[y] = df_sample[y].rolling(w, min_periods=1).mean()
+        df, df_sample = _downsample(df, max_points), _downsample(df_sample, max_points)
 
         plt.rcParams["figure.figsize"] = [12, 6]
         fig, ax1 = plt.subplots(nrows=1, ncols=1)
@@ -32,9 +56,9 @@ def plot(file=None, y=None, query=None, title='', save=False, x_tick_skip=None):
         print('[NVIZ-WARN]', e)
 
 
-def plot_cmap(file=None, query=None, save=False, x=None, y=None, title=''):
+def plot_cmap(file=None, query=None, save=False, x=None, y=None, title='', df=None, max_points=None):
     try:
-        df = pd.read_csv(file).query(query) if query else pd.read_csv(file)
+        df = _downsample(_get_df(file, df, query, columns=[x, y], max_points=max_points), max_points)
         plt.rcParams["figure.figsize"] = [12, 8]
         fig, ax1 = plt.subplots(nrows=1, ncols=1)
         z = np.linspace(0, 0.9, df[x].shape[0])
@@ -48,9 +72,9 @@ def plot_cmap(file=None, query=None, save=False, x=None, y=None, title=''):
         print('[NVIZ-WARN]', e)
 
 
-def y_scatter(file=None, query=None, y=None, save=False, title='', label=None):
+def y_scatter(file=None, query=None, y=None, save=False, title='', label=None, df=None):
     try:
-        df = pd.read_csv(file).query(query) if query else pd.read_csv(file)
+        df = _get_df(file, df, query, columns=[y, label])
         rows = np.arange(df.shape[0])
 
         plt.rcParams["figure.figsize"] = [8, 8]
@@ -74,9 +98,10 @@ def y_scatter(file=None, query=None, y=None, save=False, title='', label=None):
         print('[NVIZ-WARN]', e)
 
 
-def xy_scatter(file=None, query=None, x=None, y=None, label=None, title='', save=False):
+def xy_scatter(file=None, query=None, x=None, y=None, label=None, title='', save=False, df=None):
     try:
-        df = pd.read_csv(file).query(query) if query else pd.read_csv(file)
+        # Labels are placed by PRECISION and RECALL
+        df = _get_df(file, df, query, columns=[x, y, label] + (['PRECISION', 'RECALL'] if label else []))
         plt.rcParams["figure.figsize"] = [8, 8]
 
         fig, ax1 = plt.subplots(1, 1)
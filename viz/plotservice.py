@@ -0,0 +1,168 @@
+"""
+Renders the figures of log files(see viz.nviz) out of the training process
+### author: Aashis Khanal
+### sraashis@gmail.com
+### date: 9/10/2018
+"""
+
+import atexit
+import io
+import multiprocessing as mp
+import os
+from queue import Empty
+
+import pandas as pd
+
+import viz.nviz as nviz
+from nbee.metricstore import is_store
+
+
+class CSVTail:
+    """
+    Parsed rows of a growing csv log. Each read() parses only the complete lines added since the last one.
+    A file that was written anew(other inode or shorter) is parsed again from its header.
+    """
+
+    def __init__(self, file=None):
+        self.file = file
+        self.df = None
+        self._columns = None
+        self._offset = 0
+        self._inode = None
+
+    def read(self):
+        st = os.stat(self.file)
+        if st.st_ino != self._inode or st.st_size < self._offset:
+            self.df, self._columns, self._offset, self._inode = None, None, 0, st.st_ino
+
+        with open(self.file, 'rb') as f:
+            f.seek(self._offset)
+            chunk = f.read()
+        # A row being written is left for the next read
+        chunk = chunk[:chunk.rfind(b'\n') + 1]
+        self._offset += len(chunk)
+
+        if self._columns is None:
+            header, _, chunk = chunk.partition(b'\n')
+            self._columns = header.decode('utf-8').strip().split(',')
+        if chunk:
+            new = pd.read_csv(io.BytesIO(chunk), header=None, names=self._columns)
+            self.df = new if self.df is None else pd.concat([self.df, new], ignore_index=True)
+        if self.df is None:
+            self.df = pd.DataFrame(columns=self._columns)
+        return self.df
+
+
+def _render(tails, fn, kw):
+    try:
+        if os.path.isdir(kw['file']) and is_store(kw['file']):
+            # Columnar store(see nbee.metricstore): nviz reads only the columns and the resolution it draws
+            getattr(nviz, fn)(**kw)
+        else:
+            getattr(nviz, fn)(df=tails.setdefault(kw['file'], CSVTail(kw['file'])).read(), **kw)
+    except Exception as e:
+        print('[NVIZ-WARN]', e)
+
+
+def _parent_alive(parent):
+    # Orphans are adopted by another process(init or a subreaper)
+    if os.getppid() != parent:
+        return False
+    try:
+        os.kill(parent, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _serve(requests, parent, poll=1.0):
+    tails = {}
+    while True:
+        # Never block for good: a killed trainer sends no stop request, so the renderer checks on it every poll seconds
+        try:
+            jobs = [requests.get(timeout=poll)]
+        except Empty:
+            if not _parent_alive(parent):
+                return
+            continue
+        while True:
+            try:
+                jobs.append(requests.get_nowait())
+            except Empty:
+                break
+
+        # Same figure asked again while behind: draw it once, from the latest rows
+        pending = {}
+        for job in jobs:
+            if job is not None:
+                pending[repr(job)] = job
+        for fn, kw in pending.values():
+            _render(tails, fn, kw)
+        if None in jobs:
+            return
+
+
+class PlotService:
+    """
+    Takes plot requests(name of a viz.nviz function and its arguments) without waiting for them. A separate process
+    keeps the parsed series of each log file, adds only new rows to them and draws the figures.
+    With in_process=True figures are drawn right away in the calling process, still from the kept series.
+    """
+
+    def __init__(self, in_process=False, max_points=5000):
+        """
+        :param in_process: Draw in the calling process instead
+        :param max_points: Most points drawn per line/scatter figure of the per batch logs
+        """
+        self.in_process = in_process
+        self.max_points = max_points
+        self._tails = {}
+        self._requests, self._process = None, None
+        if not self.in_process:
+            # Spawned, not forked: the training process may already run threads(loader pool, ranks of ddp) that hold
+            # locks, and the renderer only needs viz, pandas and the metrics store
+            ctx = mp.get_context('spawn')
+            self._requests = ctx.Queue()
+            self._process = ctx.Process(target=_serve, args=(self._requests, os.getpid()), daemon=True)
+            self._process.start()
+            atexit.register(self.close)
+
+    def submit(self, fn=None, **kw):
+        """
+        :param fn: Name of a viz.nviz function
+        :param kw: Its arguments, with file(the csv log) and without df
+        """
+        if fn in ['plot', 'plot_cmap']:
+            kw.setdefault('max_points', self.max_points)
+        if self.in_process:
+            _render(self._tails, fn, kw)
+        elif self._process is not None:
+            self._requests.put((fn, kw))
+
+    def close(self):
+        """
+        Wait for the pending figures and stop the renderer.
+        """
+        if self._process is None:
+            return
+        self._requests.put(None)
+        self._process.join()
+        self._process = None
+        atexit.unregister(self.close)
+
+
+_service = None
+
+
+def get_plot_service(in_process=False):
+    """
+    :return: PlotService shared by all NNBee of the process(one renderer per run, not per split)
+    """
+    global _service
+    if _service is None or _service.in_process != in_process:
+        if _service is not None:
+            _service.close()
+        _service = PlotService(in_process=in_process)
+    return _service